@@ -1,5 +1,8 @@
 # /workspaces/addons/saj_portal_scraper/const.py
 """Constants for the SAJ Portal Scraper Add-on."""
+import array
+from functools import lru_cache
+from types import MappingProxyType
 
 # Add-on domain/slug
 DOMAIN = "saj_portal_scraper"
@@ -29,17 +32,22 @@ BASE_SAJ_URLS = [
 ]
 DEFAULT_BASE_SAJ_URL = "https://iop.saj-electric.com"
 
+@lru_cache(maxsize=4)
+def _build_saj_urls(base_url: str):
+    """Builds the (read-only) SAJ portal URL mapping for a normalized base URL."""
+    return MappingProxyType({
+        "LOGIN_URL": f"{base_url}/login",
+        "DASHBOARD_URL": f"{base_url}/index",
+        "DATA_URL_TEMPLATE": f"{base_url}/monitor/data-show-tab?deviceSn={{device_sn}}",
+        "DATA_URL_PREFIX": f"{base_url}/monitor/data-show-tab?deviceSn=", # Template without the variable part
+    })
+
 def build_saj_urls(config):
     """
     Build the SAJ portal URLs dynamically based on the config['base_saj_url'] value.
-    Returns a dict with LOGIN_URL, DASHBOARD_URL, DATA_URL_TEMPLATE.
+    Returns a read-only mapping with LOGIN_URL, DASHBOARD_URL, DATA_URL_TEMPLATE, DATA_URL_PREFIX, cached per base URL.
     """
-    base_url = config.get("base_saj_url", DEFAULT_BASE_SAJ_URL).rstrip("/")
-    return {
-        "LOGIN_URL": f"{base_url}/login",
-        "DASHBOARD_URL": f"{base_url}/index",
-        "DATA_URL_TEMPLATE": f"{base_url}/monitor/data-show-tab?deviceSn={{device_sn}}"
-    }
+    return _build_saj_urls(config.get("base_saj_url", DEFAULT_BASE_SAJ_URL).rstrip("/"))
 
 USERNAME_SELECTOR = 'input[placeholder="Username/Email"]'
 PASSWORD_SELECTOR = 'input[type="password"]'
@@ -64,6 +72,10 @@ COLUMN_MAPPING = {
     "Strength_Signal": 17,
 }
 
+# Same mapping laid out as parallel sequences for positional access while parsing table rows
+COLUMN_NAMES = tuple(COLUMN_MAPPING)
+COLUMN_INDICES = array.array("B", (COLUMN_MAPPING[name] for name in COLUMN_NAMES))
+
 # --- Sensor Property Mappings (Used for MQTT Discovery) ---
 UNIT_MAPPING = {
     "ID": None,
@@ -118,6 +130,12 @@ STATE_CLASS_MAPPING = {
     "Strength_Signal": "measurement",
 }
 
+# Merged (unit, device_class, state_class) per attribute, so lookups take a single hash
+ATTR_META = {
+    attribute: (UNIT_MAPPING.get(attribute), DEVICE_CLASS_MAPPING.get(attribute), STATE_CLASS_MAPPING.get(attribute))
+    for attribute in UNIT_MAPPING
+}
+
 # --- Inactivity Period Configuration ---
 CONF_INACTIVITY_ENABLED = "inactivity_enabled"
 CONF_INACTIVITY_START_TIME = "inactivity_start_time"
@@ -125,12 +143,22 @@ CONF_INACTIVITY_END_TIME = "inactivity_end_time"
 DEFAULT_INACTIVITY_ENABLED = True
 DEFAULT_INACTIVITY_START_TIME = "21:00"
 DEFAULT_INACTIVITY_END_TIME = "05:30"
+# Keys under which load_config stores the pre-parsed datetime.time of the window bounds
+CONF_INACTIVITY_START_PARSED = "_inactivity_start"
+CONF_INACTIVITY_END_PARSED = "_inactivity_end"
 
 # --- Dynamic Interval Configuration ---
 CONF_DATA_INACTIVITY_THRESHOLD = "data_inactivity_threshold_seconds"
 CONF_EXTENDED_UPDATE_INTERVAL = "extended_update_interval_seconds"
 DEFAULT_DATA_INACTIVITY_THRESHOLD = 1800  # Seconds (30 minutes)
 DEFAULT_EXTENDED_UPDATE_INTERVAL = 3600   # Seconds (1 hour)
+IDLE_BACKOFF_MAX_DOUBLINGS = 5 # Past the inactivity threshold, the interval doubles per idle cycle (capped by the extended interval)
+
+# --- Failure Backoff ---
+FAILURE_BACKOFF_BASE = 60   # Seconds; doubled after each consecutive login/WebDriver failure
+FAILURE_BACKOFF_MAX = 1800  # Seconds (30 minutes)
+LOGIN_FAILURE_COOLDOWN = 60 # Seconds after a failed login during which no new login is attempted
+WEBDRIVER_HEALTH_CHECK_INTERVAL = 300 # Seconds between explicit WebDriver liveness checks (successful fetches count as one)
 
 # --- MQTT Constants ---
 MQTT_BASE_TOPIC = DOMAIN # Use the add-on slug as base topic
@@ -138,6 +166,8 @@ MQTT_AVAILABILITY_TOPIC = f"{MQTT_BASE_TOPIC}/bridge/state"
 MQTT_PAYLOAD_ONLINE = "online"
 MQTT_PAYLOAD_OFFLINE = "offline"
 MQTT_DISCOVERY_PREFIX = "homeassistant" # Standard HA discovery prefix
+MQTT_MAX_INFLIGHT_MESSAGES = 100 # QoS 1 messages awaiting PUBACK at once (paho default is 20)
+MQTT_AVAILABILITY_HEARTBEAT_INTERVAL = 300 # Seconds between retained "online" re-publishes
 
 # --- Plant/Peak Sensor Names ---
 PLANT_DEVICE_NAME = "SAJ Solar Plant"
@@ -145,4 +175,14 @@ PEAK_POWER_TODAY_NAME = "Peak Power Today"
 
 # --- Persistence ---
 PERSISTENCE_FILE = "/data/peak_power_state.json" # Path inside container mapped to host
-FIREFOX_PROFILE_PATH = "/data/firefox_profile"
\ No newline at end of file
+PEAK_STATE_FLUSH_INTERVAL = 300 # Seconds; intra-day peak changes are written to disk at most this often
+FIREFOX_PROFILE_PATH = "/data/firefox_profile"
+SESSION_COOKIES_FILE = "/data/saj_cookies.json" # Portal cookies of the last login, restored before logging in again
+
+# --- Debug Page Dumps ---
+DEBUG_DUMP_DIR = "/data"
+DEBUG_DUMP_PREFIX = "saj_debug_"
+DEBUG_DUMP_INTERVAL = 300 # Seconds; at most one page source dump per interval
+DEBUG_DUMP_MAX_PER_DAY = 20 # And at most this many per (local) day
+DEBUG_DUMP_MAX_AGE_DAYS = 7 # Older dumps are deleted at startup
+DEBUG_DUMP_MAX_CHARS = 1024 * 1024 # Page sources are truncated to this many characters
@@ -3,8 +3,9 @@ import paho.mqtt.client as mqtt
 import json
 import logging
 import os
-import time
+import threading
 from datetime import date
+from functools import lru_cache
 
 from const import (
     DOMAIN,
@@ -13,16 +14,188 @@ from const import (
     MQTT_PAYLOAD_ONLINE,
     MQTT_PAYLOAD_OFFLINE,
     MQTT_DISCOVERY_PREFIX,
+    MQTT_MAX_INFLIGHT_MESSAGES,
     PLANT_DEVICE_NAME,
     PEAK_POWER_TODAY_NAME,
-    UNIT_MAPPING,
-    DEVICE_CLASS_MAPPING,
-    STATE_CLASS_MAPPING
+    ATTR_META,
 )
+from utils import json_dumps, shutdown_signals_blocked
 
 _LOGGER = logging.getLogger(__name__)
 
-_DISCOVERED_ENTITIES = set() # Keep track of discovered entities to avoid re-publishing
+class _DiscoveryState:
+    """Thread-safe record of what was already discovered in this session (one key per device)."""
+
+    def __init__(self):
+        self._seen: set[str] = set()
+        self._lock = threading.Lock()
+
+    def seen(self, key: str) -> bool:
+        with self._lock:
+            return key in self._seen
+
+    def mark(self, key: str):
+        with self._lock:
+            self._seen.add(key)
+
+# Keep track of what was already discovered in this session to avoid re-publishing.
+# Keys are device serial numbers, plus the plant and peak power entries below.
+_DISCOVERY_STATE = _DiscoveryState()
+_PLANT_DISCOVERY_KEY = "plant"
+_PEAK_DISCOVERY_KEY = "plant_peak_power_today"
+
+class _PubackTracker:
+    """Waits for the PUBACKs of a burst of QoS 1 publishes (on_publish runs in paho's network thread)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._collecting = False
+        self._pending: set[int] = set()
+        self._acked: set[int] = set() # Acks that arrived before their mid was registered
+        self._done = threading.Event()
+
+    def begin(self):
+        with self._lock:
+            self._collecting = True
+            self._pending.clear()
+            self._acked.clear()
+            self._done.clear()
+
+    def expect(self, mids: list[int]):
+        with self._lock:
+            self._collecting = False
+            self._pending = set(mids) - self._acked
+            self._acked.clear()
+            if not self._pending:
+                self._done.set()
+
+    def on_publish(self, client, userdata, mid):
+        with self._lock:
+            if mid in self._pending:
+                self._pending.discard(mid)
+                if not self._pending:
+                    self._done.set()
+            elif self._collecting:
+                self._acked.add(mid)
+
+    def wait(self, timeout: float) -> bool:
+        return self._done.wait(timeout)
+
+_DISCOVERY_ACKS = _PubackTracker()
+
+# --- Discovery Payload Templates ---
+# Panel attributes are published as "<CHANNEL>_Panel_<Metric>" and share the mappings of their generic name
+_PANEL_SUFFIXES = {
+    "_Panel_Voltage": "Panel_Voltage",
+    "_Panel_Current": "Panel_Current",
+    "_Panel_Power": "Panel_Power",
+}
+
+# Attributes without unit and device_class are not exposed as sensors (timestamps excepted)
+_SKIP_ATTRIBUTES = {
+    attribute for attribute, (unit, device_class, _) in ATTR_META.items()
+    if unit is None and device_class is None and attribute not in ["Update_time"]
+}
+
+@lru_cache(maxsize=512)
+def _slug(attribute: str) -> str:
+    """Returns the unique_id-safe slug of an attribute name."""
+    return attribute.lower().replace(" ", "_").replace("-", "_").replace(".", "_")
+
+@lru_cache(maxsize=512)
+def _display_name(attribute: str) -> str:
+    """Returns the human readable sensor name of an attribute."""
+    return attribute.replace('_', ' ').title()
+
+# Jinja value templates of the known columns; panel attributes are built on demand by _value_template()
+_VALUE_TEMPLATES = {attribute: f"{{{{ value_json.{attribute} | default('unknown') }}}}" for attribute in ATTR_META}
+
+@lru_cache(maxsize=256)
+def _value_template(attribute: str) -> str:
+    """Returns the value_template extracting an attribute from the device state JSON."""
+    return _VALUE_TEMPLATES.get(attribute) or f"{{{{ value_json.{attribute} | default('unknown') }}}}"
+
+# Static part of each sensor discovery payload, keyed by attribute. Never mutated, only copied.
+_PAYLOAD_TEMPLATES: dict[str, dict] = {}
+
+@lru_cache(maxsize=256)
+def _base_attribute(attribute: str) -> str:
+    """Returns the generic attribute name used for mapping lookups (e.g. PV1_Panel_Power -> Panel_Power)."""
+    for suffix, base_name in _PANEL_SUFFIXES.items():
+        if attribute.endswith(suffix):
+            return base_name
+    return attribute # Default to the full attribute name
+
+def _build_payload_template(attribute: str) -> dict | None:
+    """Builds the static discovery payload fields for an attribute, or None if it is not a sensor."""
+    unit, device_class, state_class = ATTR_META.get(attribute) or ATTR_META.get(_base_attribute(attribute), (None, None, None))
+
+    if unit is None and device_class is None and attribute not in ["Update_time"]:
+        return None
+
+    # Ensure timestamps have the correct device class (overrides mapping if needed)
+    if attribute in ["Update_time"]:
+        device_class = "timestamp"
+
+    # Use the ORIGINAL attribute name for the sensor name and value template
+    template = {
+        "name": _display_name(attribute),
+        "value_template": _value_template(attribute),
+        "availability_topic": MQTT_AVAILABILITY_TOPIC,
+        "payload_available": MQTT_PAYLOAD_ONLINE,
+        "payload_not_available": MQTT_PAYLOAD_OFFLINE,
+    }
+    if unit: template["unit_of_measurement"] = unit
+    if device_class: template["device_class"] = device_class
+    if state_class: template["state_class"] = state_class
+    return template
+
+def _get_payload_template(attribute: str) -> dict | None:
+    """Returns the cached discovery payload template for an attribute, building it on first use."""
+    template = _PAYLOAD_TEMPLATES.get(attribute)
+    if template is None and attribute not in _SKIP_ATTRIBUTES:
+        template = _build_payload_template(attribute)
+        if template is None:
+            _SKIP_ATTRIBUTES.add(attribute)
+        else:
+            _PAYLOAD_TEMPLATES[attribute] = template
+    return template
+
+# Serialized discovery payloads keyed by (unique_id, addon_version); a version bump re-serializes
+_DISCOVERY_PAYLOAD_BYTES: dict[tuple[str, str], bytes] = {}
+
+def _encode_discovery_payload(unique_id: str, addon_version: str, payload: dict, device_json: bytes) -> bytes:
+    """Serializes a discovery payload, splices in the pre-serialized "device" block and caches it."""
+    # The device block is identical for every sensor of a device, so it is serialized once per device
+    payload_bytes = json_dumps(payload)[:-1] + b',"device":' + device_json + b'}'
+    _DISCOVERY_PAYLOAD_BYTES[(unique_id, addon_version)] = payload_bytes
+    return payload_bytes
+
+# Hash of the last state payload published per topic; unchanged payloads are not re-sent.
+# Cleared on every (re)connection since the broker may have lost its retained messages.
+_LAST_STATE_HASH: dict[str, int] = {}
+
+# Latest (payload, qos) per state topic produced while disconnected; sent as soon as the broker is back.
+# Keyed by topic, so it never holds more than one message per topic.
+_PENDING_STATE: dict[str, tuple[bytes, int]] = {}
+_PENDING_STATE_LOCK = threading.Lock()
+
+# last_reset_date changes at most once a day, so keep its ISO string around
+_ISO_CACHE: tuple[date, str] | None = None
+
+def _iso_reset_date(last_reset_date: date | None) -> str | None:
+    """Returns the ISO string of last_reset_date, reusing the cached one when the date is unchanged."""
+    global _ISO_CACHE
+    if last_reset_date is None:
+        return None
+    if _ISO_CACHE is None or _ISO_CACHE[0] != last_reset_date:
+        _ISO_CACHE = (last_reset_date, last_reset_date.isoformat())
+    return _ISO_CACHE[1]
+
+# Pre-build the templates and slugs for every known column at import time
+for _attribute in ATTR_META:
+    _get_payload_template(_attribute)
+    _slug(_attribute)
 
 def get_mqtt_config(addon_config):
     """Gets MQTT connection details from add-on config or Supervisor."""
@@ -35,10 +208,11 @@ def get_mqtt_config(addon_config):
     if not host:
         try:
             _LOGGER.info("MQTT host not found in config, trying Supervisor service discovery...")
-            host = os.getenv("MQTT_BROKER")
-            port = int(os.getenv("MQTT_PORT", 1883))
-            username = os.getenv("MQTT_USERNAME")
-            password = os.getenv("MQTT_PASSWORD")
+            env = os.environ
+            host = env.get("MQTT_BROKER")
+            port = env.get("MQTT_PORT") # Converted to int once below
+            username = env.get("MQTT_USERNAME")
+            password = env.get("MQTT_PASSWORD")
             if host:
                 _LOGGER.info("Using Supervisor-provided MQTT configuration.")
             else:
@@ -67,8 +241,9 @@ def get_mqtt_config(addon_config):
     }
 
 
-def connect_mqtt(client_id: str, config: dict) -> mqtt.Client | None:
-    """Connects to the MQTT broker."""
+def connect_mqtt(client_id: str, config: dict, wait_timeout: float = 10) -> mqtt.Client | None:
+    """Connects to the MQTT broker in the background and returns the client.
+    Waits up to wait_timeout seconds for the first connection; paho keeps retrying after that."""
     mqtt_config = get_mqtt_config(config)
     if not mqtt_config:
         return None
@@ -81,32 +256,102 @@ def connect_mqtt(client_id: str, config: dict) -> mqtt.Client | None:
     if mqtt_config.get("username"):
         client.username_pw_set(mqtt_config["username"], mqtt_config.get("password"))
 
+    # Signalled by the network thread as soon as the broker accepts the connection (CONNACK)
+    connected = threading.Event()
+
+    def _on_connect(client, userdata, flags, rc):
+        if rc == 0:
+            _LAST_STATE_HASH.clear()
+            # Publish online status upon every successful (re)connection
+            client.publish(MQTT_AVAILABILITY_TOPIC, payload=MQTT_PAYLOAD_ONLINE, qos=1, retain=True)
+            # Deliver the state queued while the broker was unreachable. The flag flips under the same lock
+            # publish_state queues under, so nothing can be queued after this drain and then left behind
+            with _PENDING_STATE_LOCK:
+                client._saj_connected = True
+                pending = list(_PENDING_STATE.items())
+                _PENDING_STATE.clear()
+            for topic, (payload, qos) in pending:
+                client.publish(topic, payload, qos=qos, retain=True)
+                _LAST_STATE_HASH[topic] = hash(payload)
+            if pending:
+                _LOGGER.info(f"Published {len(pending)} state message(s) queued while disconnected.")
+            connected.set()
+        else:
+            _LOGGER.warning(f"MQTT broker refused the connection (rc={rc}).")
+
+    def _on_disconnect(client, userdata, rc):
+        client._saj_connected = False
+
+    # Connection state is mirrored into a plain attribute by the callbacks, so the publish
+    # guards don't need to take paho's lock through is_connected()
+    client._saj_connected = False
+    client.on_connect = _on_connect
+    client.on_disconnect = _on_disconnect
+    client.on_publish = _DISCOVERY_ACKS.on_publish
+    # Back off automatically between reconnection attempts of the network loop
+    client.reconnect_delay_set(min_delay=1, max_delay=180)
+    # Let a whole discovery burst be pipelined on the connection instead of trickling out as PUBACKs return
+    client.max_inflight_messages_set(MQTT_MAX_INFLIGHT_MESSAGES)
+
     try:
         _LOGGER.info(f"Connecting to MQTT broker at {mqtt_config['host']}:{mqtt_config['port']}...")
-        client.connect(mqtt_config['host'], mqtt_config['port'], 60)
-        client.loop_start()
-        time.sleep(1) # Short pause to allow connection establishment
-        if client.is_connected():
+        # The network thread performs the (re)connection, so a broker outage never blocks the caller
+        client.connect_async(mqtt_config['host'], mqtt_config['port'], 60)
+        with shutdown_signals_blocked(): # The network thread inherits the mask
+            client.loop_start()
+        if connected.wait(timeout=wait_timeout):
              _LOGGER.info("MQTT connected successfully.")
-             # Publish online status upon successful connection
-             client.publish(MQTT_AVAILABILITY_TOPIC, payload=MQTT_PAYLOAD_ONLINE, qos=1, retain=True)
-             return client
         else:
-             _LOGGER.error("MQTT connection attempt failed (client not connected after connect call).")
-             client.loop_stop()
-             return None
+             _LOGGER.warning(f"MQTT not connected yet (no CONNACK within {wait_timeout} seconds). Retrying in the background.")
+        return client
     except Exception as e:
         _LOGGER.error(f"MQTT connection error: {e}", exc_info=True)
         # Ensure loop_stop is called even if connect fails
         if client: client.loop_stop()
         return None
 
-def publish_discovery(client: mqtt.Client, device_data: dict, plant_data: dict, peak_power_state: dict, addon_version: str):
-    """Publishes MQTT discovery messages for all sensors."""
-    if not client or not client.is_connected():
+def publish_availability(client: mqtt.Client):
+    """Re-publishes the retained online status, as a heartbeat for cycles that publish no state."""
+    if not client or not getattr(client, "_saj_connected", False):
+        return
+    try:
+        client.publish(MQTT_AVAILABILITY_TOPIC, payload=MQTT_PAYLOAD_ONLINE, qos=1, retain=True)
+    except Exception as e:
+        _LOGGER.error(f"Failed to publish availability TO {MQTT_AVAILABILITY_TOPIC}: {e}")
+
+def has_published_state() -> bool:
+    """Returns True if state has been published since the last (re)connection to the broker."""
+    return bool(_LAST_STATE_HASH)
+
+def _flush_messages(client: mqtt.Client, messages: list[tuple[str, bytes, bool]], qos: int = 1, mids: list[int] | None = None) -> set[str]:
+    """Publishes a batch of already-serialized (topic, payload, retain) messages back to back.
+    Returns the topics that failed to publish; the message ids are appended to mids if given."""
+    failed_topics = set()
+    for topic, payload, retain in messages:
+        try:
+            info = client.publish(topic, payload, qos=qos, retain=retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                _LOGGER.warning(f"Failed to publish TO {topic}: rc={info.rc}")
+                failed_topics.add(topic)
+            elif mids is not None:
+                mids.append(info.mid)
+        except Exception as e:
+            # Catch errors during the publish call itself
+            _LOGGER.error(f"Failed to publish TO {topic}: {e}")
+            failed_topics.add(topic)
+    return failed_topics
+
+def publish_discovery(client: mqtt.Client, device_data: dict, plant_data: dict, peak_power_state: dict, addon_version: str, ack_timeout: float = 0):
+    """Publishes MQTT discovery messages for all sensors.
+    With ack_timeout, waits up to that many seconds for the broker to acknowledge every message."""
+    if not client or not getattr(client, "_saj_connected", False):
         _LOGGER.warning("MQTT client not connected, skipping discovery.")
         return
 
+    # All discovery messages are collected first and handed to paho in a single burst
+    messages: list[tuple[str, bytes, bool]] = []
+    device_topics: dict[str, list[str]] = {} # Discovery topics per SN, to mark devices discovered after the flush
+
     # Define Plant Device Info ONCE
     plant_sn = "plant_aggregator"
     # Unique identifier string for the aggregated plant device
@@ -118,9 +363,13 @@ def publish_discovery(client: mqtt.Client, device_data: dict, plant_data: dict,
         "model": "Aggregated Plant Data",
         "sw_version": addon_version,
     }
+    plant_device_json = json_dumps(plant_device_info)
 
     # --- Individual Device Discovery ---
     for sn, data in device_data.items():
+        # Avoid re-publishing discovery for devices already discovered in this session
+        if _DISCOVERY_STATE.seen(sn): continue
+
         alias = data.get("Alias", sn)
         # Unique identifier string for the individual microinverter device
         device_unique_identifier = f"{DOMAIN}_{sn}"
@@ -134,227 +383,187 @@ def publish_discovery(client: mqtt.Client, device_data: dict, plant_data: dict,
             "via_device": plant_unique_identifier,
             "serial_number": sn,
         }
-        for attribute, value in data.items():
+        device_json = json_dumps(device_info)
+        topics = device_topics[sn] = []
+        # Per-device string prefixes, so each attribute only needs concatenation
+        unique_id_prefix = f"saj_{sn}_"
+        discovery_topic_prefix = f"{MQTT_DISCOVERY_PREFIX}/sensor/{unique_id_prefix}"
+        state_topic = f"{MQTT_BASE_TOPIC}/{sn}/state"
+        for attribute in data:
             if attribute == "Alias": continue # Alias is part of device_info, not a sensor
 
-            attribute_slug = attribute.lower().replace(" ", "_").replace("-", "_").replace(".", "_")
-            unique_id = f"saj_{sn}_{attribute_slug}"
-
-            # Avoid re-publishing discovery for entities already discovered in this session
-            if unique_id in _DISCOVERED_ENTITIES: continue
-
-            unit = None
-            device_class = None
-            state_class = None
-            base_attribute = attribute # Default to the full attribute name
-            identified_panel_attribute = False
-
-            panel_suffixes = {
-                "_Panel_Voltage": "Panel_Voltage",
-                "_Panel_Current": "Panel_Current",
-                "_Panel_Power": "Panel_Power",
-            }
-
-            for suffix, base_name in panel_suffixes.items():
-                if attribute.endswith(suffix):
-                    base_attribute = base_name # Use the generic name for mapping lookup
-                    identified_panel_attribute = True
-                    break # Found the panel type
+            attribute_slug = _slug(attribute)
+            unique_id = unique_id_prefix + attribute_slug
 
-            # Look up mappings using the determined base_attribute
-            unit = UNIT_MAPPING.get(base_attribute)
-            device_class = DEVICE_CLASS_MAPPING.get(base_attribute)
-            state_class = STATE_CLASS_MAPPING.get(base_attribute)
-            # --- MODIFICATION END ---
+            template = _get_payload_template(attribute)
+            if template is None:
+                 _LOGGER.debug("Skipping discovery for %s due to missing unit and device_class.", unique_id)
+                 continue
 
-            icon = None # Reset icon for each attribute
+            discovery_topic = discovery_topic_prefix + attribute_slug + "/config"
 
-            # Skip attributes that don't map to a sensor property (unless it's a timestamp)
-            # This check now works correctly even if the panel prefix wasn't "PV"
-            if unit is None and device_class is None and attribute not in ["Update_time"]:
-                 _LOGGER.debug(f"Skipping discovery for {unique_id} due to missing unit and device_class (Base Attribute: {base_attribute}).")
-                 continue
+            payload_bytes = _DISCOVERY_PAYLOAD_BYTES.get((unique_id, addon_version))
+            if payload_bytes is None:
+                payload = {
+                    **template,
+                    "unique_id": unique_id,
+                    "state_topic": state_topic,
+                }
+                payload_bytes = _encode_discovery_payload(unique_id, addon_version, payload, device_json)
 
-            # Ensure timestamps have the correct device class (overrides mapping if needed)
-            if attribute in ["Update_time"]:
-                 device_class = "timestamp"
+            _LOGGER.debug("Discovery Check: For unique_id '%s', defining state_topic as: '%s' with payload: %s", unique_id, state_topic, payload_bytes)
+            messages.append((discovery_topic, payload_bytes, True))
+            topics.append(discovery_topic)
 
-            discovery_topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/{unique_id}/config"
-            state_topic = f"{MQTT_BASE_TOPIC}/{sn}/state"
+    # --- Aggregated Plant Discovery ---
+    # Reuses plant_device_json defined earlier
+    plant_topics: list[str] = []
+    if plant_data and not _DISCOVERY_STATE.seen(_PLANT_DISCOVERY_KEY):
+        plant_state_topic = f"{MQTT_BASE_TOPIC}/plant/state"
+        plant_discovery_topic_prefix = f"{MQTT_DISCOVERY_PREFIX}/sensor/saj_plant_"
+        for attribute in plant_data:
+            attribute_slug = _slug(attribute)
+            unique_id = "saj_plant_" + attribute_slug
+
+            # Skip non-sensor attributes, except timestamps
+            template = _get_payload_template(attribute)
+            if template is None: continue
+
+            discovery_topic = plant_discovery_topic_prefix + attribute_slug + "/config"
+            payload_bytes = _DISCOVERY_PAYLOAD_BYTES.get((unique_id, addon_version))
+            if payload_bytes is None:
+                payload = {
+                    **template,
+                    "unique_id": unique_id,
+                    "state_topic": plant_state_topic,
+                }
+                payload_bytes = _encode_discovery_payload(unique_id, addon_version, payload, plant_device_json)
+
+            messages.append((discovery_topic, payload_bytes, True))
+            plant_topics.append(discovery_topic)
 
-            # Use the ORIGINAL attribute name for the sensor name and value template
-            payload = {
-                "name": f"{attribute.replace('_', ' ').title()}",
-                "unique_id": unique_id,
-                "state_topic": state_topic,
-                "value_template": f"{{{{ value_json.{attribute} | default('unknown') }}}}", # Uses original attribute
-                "device": device_info,
+    # --- Peak Power Discovery ---
+    # Reuses plant_device_json defined earlier
+    peak_unique_id = "saj_plant_peak_power_today"
+    peak_discovery_topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/{peak_unique_id}/config"
+    peak_pending: bool = not _DISCOVERY_STATE.seen(_PEAK_DISCOVERY_KEY)
+    if peak_pending:
+        peak_payload_bytes = _DISCOVERY_PAYLOAD_BYTES.get((peak_unique_id, addon_version))
+        if peak_payload_bytes is None:
+            peak_state_topic = f"{MQTT_BASE_TOPIC}/plant/peak_power_today"
+            peak_payload = {
+                "name": PEAK_POWER_TODAY_NAME,
+                "unique_id": peak_unique_id,
+                "state_topic": peak_state_topic,
+                "value_template": "{{ value_json.value | default(0) }}",
                 "availability_topic": MQTT_AVAILABILITY_TOPIC,
                 "payload_available": MQTT_PAYLOAD_ONLINE,
                 "payload_not_available": MQTT_PAYLOAD_OFFLINE,
-              #  "json_attributes_topic": state_topic,
-              #  "json_attributes_template": "{{ value_json | tojson }}",
+                "unit_of_measurement": ATTR_META["Power"][0],
+                "device_class": ATTR_META["Power"][1],
+                "state_class": ATTR_META["Power"][2],
+                "icon": "mdi:weather-sunny-alert",
+                "json_attributes_topic": peak_state_topic,
+                # Extract last_reset_date as an attribute
+                "json_attributes_template": "{{ {'last_reset_date': value_json.last_reset_date} | tojson if value_json is mapping else None }}",
             }
-            # Add properties based on mappings found using base_attribute
-            if unit: payload["unit_of_measurement"] = unit
-            if device_class: payload["device_class"] = device_class
-            if state_class: payload["state_class"] = state_class
-            if icon: payload["icon"] = icon
-
-            _LOGGER.debug(f"Discovery Check: For unique_id '{unique_id}', defining state_topic as: '{payload['state_topic']}'")
-
-            try:
-                _LOGGER.debug(f"Attempting to publish discovery for {unique_id} (Base Attribute: {base_attribute}) with payload: {json.dumps(payload)}")
-                client.publish(discovery_topic, json.dumps(payload), qos=1, retain=True)
-                _DISCOVERED_ENTITIES.add(unique_id)
-                _LOGGER.debug(f"Published discovery for: {unique_id}")
-            except Exception as e:
-                 _LOGGER.error(f"Failed to publish discovery for {unique_id}: {e}")
-
-    # --- Aggregated Plant Discovery ---
-    # Reuses plant_device_info defined earlier
-    plant_state_topic = f"{MQTT_BASE_TOPIC}/plant/state"
-    for attribute, value in plant_data.items():
-        attribute_slug = attribute.lower().replace(" ", "_").replace("-", "_").replace(".", "_")
-        unique_id = f"saj_plant_{attribute_slug}"
-
-        if unique_id in _DISCOVERED_ENTITIES: continue
-
-        unit = UNIT_MAPPING.get(attribute)
-        device_class = DEVICE_CLASS_MAPPING.get(attribute)
-        state_class = STATE_CLASS_MAPPING.get(attribute)
-        icon = None
-
-        # Skip non-sensor attributes, except timestamps
-        if unit is None and device_class is None and attribute not in ["Update_time"]: continue
-        if attribute in ["Update_time"]: device_class = "timestamp"
-
-        discovery_topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/{unique_id}/config"
-        payload = {
-            "name": f"{attribute.replace('_', ' ').title()}",
-            "unique_id": unique_id,
-            "state_topic": plant_state_topic,
-            "value_template": f"{{{{ value_json.{attribute} | default('unknown') }}}}",
-            "device": plant_device_info,
-            "availability_topic": MQTT_AVAILABILITY_TOPIC,
-            "payload_available": MQTT_PAYLOAD_ONLINE,
-            "payload_not_available": MQTT_PAYLOAD_OFFLINE,
-           # "json_attributes_topic": plant_state_topic,
-           # "json_attributes_template": "{{ value_json | tojson }}",
-        }
-        if unit: payload["unit_of_measurement"] = unit
-        if device_class: payload["device_class"] = device_class
-        if state_class: payload["state_class"] = state_class
-        if icon: payload["icon"] = icon
-
-        try:
-            client.publish(discovery_topic, json.dumps(payload), qos=1, retain=True)
-            _DISCOVERED_ENTITIES.add(unique_id)
-            _LOGGER.debug(f"Published discovery for: {unique_id}")
-        except Exception as e:
-            _LOGGER.error(f"Failed to publish discovery for {unique_id}: {e}")
-
+            peak_payload_bytes = _encode_discovery_payload(peak_unique_id, addon_version, peak_payload, plant_device_json)
+        messages.append((peak_discovery_topic, peak_payload_bytes, True))
+
+    mids: list[int] = []
+    _DISCOVERY_ACKS.begin()
+    failed_topics = _flush_messages(client, messages, mids=mids)
+    _DISCOVERY_ACKS.expect(mids)
+    _LOGGER.debug("Published %d/%d discovery messages.", len(messages) - len(failed_topics), len(messages))
+    if ack_timeout and mids and not _DISCOVERY_ACKS.wait(ack_timeout):
+        _LOGGER.warning(f"Not all discovery messages were acknowledged by the broker within {ack_timeout} seconds.")
+
+    # Only mark as discovered what was fully published, so failures are retried on the next call
+    for sn, topics in device_topics.items():
+        if failed_topics.isdisjoint(topics):
+            _DISCOVERY_STATE.mark(sn)
+    if plant_topics and failed_topics.isdisjoint(plant_topics):
+        _DISCOVERY_STATE.mark(_PLANT_DISCOVERY_KEY)
+    if peak_pending and peak_discovery_topic not in failed_topics:
+        _DISCOVERY_STATE.mark(_PEAK_DISCOVERY_KEY)
+
+def publish_state(client: mqtt.Client, device_data: dict, plant_data: dict, peak_power: float, last_reset_date: date | None, state_qos: int = 0):
+    """Publishes the current state data to MQTT topics.
+    State topics are retained, so payloads identical to the last published one are skipped.
+    While disconnected, the latest state is queued and sent by the client on reconnection."""
+    # QoS 0 is enough here: every state is a retained, idempotent overwrite that the next cycle
+    # supersedes anyway, so waiting on a PUBACK per message buys nothing. Availability stays QoS 1.
+    if not client:
+        _LOGGER.warning("No MQTT client, skipping state publish.")
+        return
 
-    # --- Peak Power Discovery ---
-    # Reuses plant_device_info defined earlier
-    peak_unique_id = "saj_plant_peak_power_today"
-    if peak_unique_id not in _DISCOVERED_ENTITIES:
-        peak_discovery_topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/{peak_unique_id}/config"
-        peak_state_topic = f"{MQTT_BASE_TOPIC}/plant/peak_power_today"
-        peak_payload = {
-            "name": PEAK_POWER_TODAY_NAME,
-            "unique_id": peak_unique_id,
-            "state_topic": peak_state_topic,
-            "value_template": "{{ value_json.value | default(0) }}",
-            "device": plant_device_info,
-            "availability_topic": MQTT_AVAILABILITY_TOPIC,
-            "payload_available": MQTT_PAYLOAD_ONLINE,
-            "payload_not_available": MQTT_PAYLOAD_OFFLINE,
-            "unit_of_measurement": UNIT_MAPPING.get("Power"),
-            "device_class": DEVICE_CLASS_MAPPING.get("Power"),
-            "state_class": STATE_CLASS_MAPPING.get("Power"),
-            "icon": "mdi:weather-sunny-alert",
-            "json_attributes_topic": peak_state_topic,
-            # Extract last_reset_date as an attribute
-            "json_attributes_template": "{{ {'last_reset_date': value_json.last_reset_date} | tojson if value_json is mapping else None }}",
-        }
-        try:
-            client.publish(peak_discovery_topic, json.dumps(peak_payload), qos=1, retain=True)
-            _DISCOVERED_ENTITIES.add(peak_unique_id)
-            _LOGGER.debug(f"Published discovery for: {peak_unique_id}")
-        except Exception as e:
-            _LOGGER.error(f"Failed to publish discovery for {peak_unique_id}: {e}")
+    # Serialize everything first, then hand all messages to paho in one burst
+    messages: list[tuple[str, bytes, bool]] = []
+    payload_hashes: dict[str, int] = {}
 
-def publish_state(client: mqtt.Client, device_data: dict, plant_data: dict, peak_power: float, last_reset_date: date | None):
-    """Publishes the current state data to MQTT topics."""
-    if not client or not client.is_connected():
-        _LOGGER.warning("MQTT client not connected, skipping state publish.")
-        return
+    def _stage(topic: str, payload: bytes) -> None:
+        payload_hash = hash(payload)
+        if _LAST_STATE_HASH.get(topic) == payload_hash:
+            _LOGGER.debug("State for %s unchanged since last publish, skipping.", topic)
+            return
+        payload_hashes[topic] = payload_hash
+        messages.append((topic, payload, True))
 
-    # Publish individual device states
+    # Individual device states
     for sn, data in device_data.items():
         state_topic = f"{MQTT_BASE_TOPIC}/{sn}/state"
+        update_time_val = data.get("Update_time", "N/A") # Use .get() with default for logging
+        _LOGGER.debug("State Publish Check: Publishing state for device '%s' TO topic: '%s'. Update_time='%s'", sn, state_topic, update_time_val)
         try:
-            update_time_val = data.get("Update_time", "N/A") # Use .get() with default for logging
-            _LOGGER.debug(f"State Publish Check: Publishing state for device '{sn}' TO topic: '{state_topic}'. Update_time='{update_time_val}'")
-
-            # --- ADDED LOGGING ---
-            try:
-                json_payload = json.dumps(data)
-                _LOGGER.debug(f"State Publish Payload for {sn} TO {state_topic}: {json_payload}")
-            except (TypeError, ValueError) as json_err:
-                _LOGGER.error(f"Error serializing state data for {sn} to JSON: {json_err}. Data: {data}")
-                continue # Skip publishing if JSON fails
-            # --- END ADDED LOGGING ---
-
-            # Publish the full data dictionary as JSON
-            client.publish(state_topic, json_payload, qos=1, retain=False) # Use the generated json_payload
-
-        except Exception as e:
-            # Catch errors during the publish call itself
-            _LOGGER.error(f"Failed to publish state for device {sn} TO {state_topic}: {e}")
+            json_payload = json_dumps(data)
+            _LOGGER.debug("State Publish Payload for %s TO %s: %s", sn, state_topic, json_payload)
+        except (TypeError, ValueError) as json_err:
+            _LOGGER.error(f"Error serializing state data for {sn} to JSON: {json_err}. Data: {data}")
+            continue # Skip publishing if JSON fails
+        _stage(state_topic, json_payload)
 
-    # Publish aggregated plant state
+    # Aggregated plant state
     plant_state_topic = f"{MQTT_BASE_TOPIC}/plant/state"
+    plant_update_time = plant_data.get("Update_time", "N/A")
+    _LOGGER.debug("Publishing aggregated plant state to %s. Update_time='%s'", plant_state_topic, plant_update_time)
     try:
-        plant_update_time = plant_data.get("Update_time", "N/A")
-        _LOGGER.debug(f"Publishing aggregated plant state to {plant_state_topic}. Update_time='{plant_update_time}'")
-
-        try:
-            json_payload_plant = json.dumps(plant_data)
-            _LOGGER.debug(f"State Publish Payload for Plant TO {plant_state_topic}: {json_payload_plant}")
-        except (TypeError, ValueError) as json_err:
-            _LOGGER.error(f"Error serializing plant state data to JSON: {json_err}. Data: {plant_data}")
-            json_payload_plant = None # Prevent publishing if JSON fails
-
-        if json_payload_plant: # Only publish if JSON serialization succeeded
-            client.publish(plant_state_topic, json_payload_plant, qos=1, retain=False)
-
-    except Exception as e:
-        # Catch errors during the publish call itself
-        _LOGGER.error(f"Failed to publish plant state TO {plant_state_topic}: {e}")
+        json_payload_plant = json_dumps(plant_data)
+        _LOGGER.debug("State Publish Payload for Plant TO %s: %s", plant_state_topic, json_payload_plant)
+        _stage(plant_state_topic, json_payload_plant)
+    except (TypeError, ValueError) as json_err:
+        _LOGGER.error(f"Error serializing plant state data to JSON: {json_err}. Data: {plant_data}")
 
-    # Publish peak power state
+    # Peak power state
     peak_state_topic = f"{MQTT_BASE_TOPIC}/plant/peak_power_today"
-    peak_payload_dict = { # Renamed variable for clarity
+    peak_payload_dict = {
         "value": peak_power,
-        "last_reset_date": last_reset_date.isoformat() if last_reset_date else None
+        "last_reset_date": _iso_reset_date(last_reset_date) # ISO date string (or null)
     }
     try:
+        json_payload_peak = json_dumps(peak_payload_dict)
+        _LOGGER.debug("State Publish Payload for Peak Power TO %s: %s", peak_state_topic, json_payload_peak)
+        _stage(peak_state_topic, json_payload_peak)
+    except (TypeError, ValueError) as json_err:
+        _LOGGER.error(f"Error serializing peak power state data to JSON: {json_err}. Data: {peak_payload_dict}")
+
+    # Checked and queued atomically with respect to _on_connect's flag update and drain
+    with _PENDING_STATE_LOCK:
+        connected = getattr(client, "_saj_connected", False)
+        if not connected:
+            _PENDING_STATE.update((topic, (payload, state_qos)) for topic, payload, _ in messages)
+    if not connected:
+        _LOGGER.warning("MQTT client not connected. Queued %d state message(s) until it reconnects.", len(messages))
+        return
 
-        try:
-            json_payload_peak = json.dumps(peak_payload_dict)
-            _LOGGER.debug(f"State Publish Payload for Peak Power TO {peak_state_topic}: {json_payload_peak}")
-        except (TypeError, ValueError) as json_err:
-            _LOGGER.error(f"Error serializing peak power state data to JSON: {json_err}. Data: {peak_payload_dict}")
-            json_payload_peak = None # Prevent publishing if JSON fails
-
-
-        if json_payload_peak: # Only publish if JSON serialization succeeded
-            # Retain peak power state so it's available on HA restart
-            client.publish(peak_state_topic, json_payload_peak, qos=1, retain=True)
-
-    except Exception as e:
-        # Catch errors during the publish call itself
-        _LOGGER.error(f"Failed to publish peak power state TO {peak_state_topic}: {e}")
-
+    failed_topics = _flush_messages(client, messages, qos=state_qos)
+    with _PENDING_STATE_LOCK:
+        for topic, payload, _ in messages:
+            if topic not in failed_topics:
+                # A queued payload for this topic is now stale; it must not overwrite this one on a reconnect
+                _PENDING_STATE.pop(topic, None)
+            elif not client._saj_connected:
+                # Lost the connection mid-flush: send it with the queued state once the broker is back
+                _PENDING_STATE[topic] = (payload, state_qos)
+    for topic, payload_hash in payload_hashes.items():
+        if topic not in failed_topics:
+            _LAST_STATE_HASH[topic] = payload_hash
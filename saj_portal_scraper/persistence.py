@@ -1,17 +1,19 @@
 # /workspaces/addons/saj_portal_scraper/persistence.py
 import json
 import logging
+import os
 from datetime import date
 
-from const import PERSISTENCE_FILE
+from const import PERSISTENCE_FILE, SESSION_COOKIES_FILE
+from utils import json_dumps, json_loads
 
 _LOGGER = logging.getLogger(__name__)
 
 def load_peak_power_state() -> tuple[float, date | None]:
     """Loads the peak power value and last reset date from the persistence file."""
     try:
-        with open(PERSISTENCE_FILE, 'r') as f:
-            state_data = json.load(f)
+        with open(PERSISTENCE_FILE, 'rb') as f:
+            state_data = json_loads(f.read())
             peak = float(state_data.get("peak_power_today", 0.0))
             reset_date_str = state_data.get("last_reset_date")
             reset_date = date.fromisoformat(reset_date_str) if reset_date_str else None
@@ -30,9 +32,35 @@ def save_peak_power_state(peak: float, reset_date: date | None):
         "peak_power_today": peak,
         "last_reset_date": reset_date.isoformat() if reset_date else None
     }
+    tmp_file = f"{PERSISTENCE_FILE}.tmp"
     try:
-        with open(PERSISTENCE_FILE, 'w') as f:
-            json.dump(state_data, f, indent=2)
+        # Write to a temporary file and rename it over the old one, so a crash never leaves a truncated file
+        with open(tmp_file, 'wb') as f:
+            f.write(json_dumps(state_data))
+        os.replace(tmp_file, PERSISTENCE_FILE)
         _LOGGER.debug(f"Saved peak power state to {PERSISTENCE_FILE}: {state_data}")
     except IOError as e:
         _LOGGER.error(f"Error saving peak power state to {PERSISTENCE_FILE}: {e}")
+
+def load_session_cookies() -> list[dict]:
+    """Loads the portal cookies saved after the last login. Returns an empty list if there are none."""
+    try:
+        with open(SESSION_COOKIES_FILE, 'rb') as f:
+            cookies = json_loads(f.read())
+        return cookies if isinstance(cookies, list) else []
+    except FileNotFoundError:
+        return []
+    except (json.JSONDecodeError, ValueError, TypeError) as e:
+        _LOGGER.warning(f"Error loading session cookies from {SESSION_COOKIES_FILE}: {e}. Ignoring them.")
+        return []
+
+def save_session_cookies(cookies: list[dict]):
+    """Saves the portal cookies (as returned by driver.get_cookies()) for the next start."""
+    tmp_file = f"{SESSION_COOKIES_FILE}.tmp"
+    try:
+        with open(tmp_file, 'wb') as f:
+            f.write(json_dumps(cookies))
+        os.replace(tmp_file, SESSION_COOKIES_FILE)
+        _LOGGER.debug(f"Saved {len(cookies)} session cookie(s) to {SESSION_COOKIES_FILE}")
+    except IOError as e:
+        _LOGGER.error(f"Error saving session cookies to {SESSION_COOKIES_FILE}: {e}")
@@ -6,8 +6,13 @@ import logging
 import signal
 import sys
 import os
+import queue
+import random
+import threading
 import subprocess # <-- ADDED for version checking
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
 from datetime import date, datetime
+from functools import lru_cache
 
 from const import (
     DOMAIN,
@@ -27,6 +32,12 @@ from const import (
     CONF_EXTENDED_UPDATE_INTERVAL,
     DEFAULT_DATA_INACTIVITY_THRESHOLD,
     DEFAULT_EXTENDED_UPDATE_INTERVAL,
+    IDLE_BACKOFF_MAX_DOUBLINGS,
+    FAILURE_BACKOFF_BASE,
+    FAILURE_BACKOFF_MAX,
+    MQTT_AVAILABILITY_HEARTBEAT_INTERVAL,
+    PEAK_STATE_FLUSH_INTERVAL,
+    WEBDRIVER_HEALTH_CHECK_INTERVAL,
     FIREFOX_BINARY_PATH, # <-- ADDED for version checking
     GECKODRIVER_PATH,    # <-- ADDED for version checking
     build_saj_urls,  # Importa função para URLs dinâmicas
@@ -36,8 +47,12 @@ import utils
 import mqtt_utils
 import persistence
 import requests
+from requests.adapters import HTTPAdapter
 
 OPTIONS_FILE = "/data/options.json"
+SUPERVISOR_TIMEOUT = (2, 5) # (connect, read) seconds for Supervisor API calls
+CYCLE_SHUTDOWN_TIMEOUT = 5 # Seconds shutdown waits for an in-flight cycle before cleaning up under it
+CLIENT_ID = f"{DOMAIN}-addon-{os.getpid()}" # MQTT client id, stable across reconnects of this process
 CONFIG = {}
 ADDON_VERSION = ""
 
@@ -47,22 +62,43 @@ _LOGGER = logging.getLogger(__name__)
 # --- Global State ---
 mqtt_client = None
 webdriver = None
-shutdown_requested = False
+_shutdown_event = threading.Event() # Set by handle_shutdown; lets the main loop sleep without polling
+_cycle_wakeup = threading.Event() # Set when a cycle finishes or shutdown is requested
+_cycle_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="run_cycle", initializer=utils.block_shutdown_signals) # Runs one cycle at a time
+_last_availability_publish = 0.0 # Monotonic time of the last availability heartbeat
+_inactive_cache: tuple[float, bool] | None = None # (monotonic time valid until, cached is_inactive result)
 current_peak_power: float = 0.0
 last_reset_date: date | None = None
+_peak_dirty = False # Peak power state changed since it was last written to disk
+_peak_last_flush = 0.0 # Monotonic time of the last peak power state write
+_persist_queue: queue.Queue = queue.Queue(maxsize=1) # Latest (peak, reset_date) waiting to be written; None stops the writer
+_persist_lock = threading.Lock() # Serializes producers replacing the queued state
+_persist_thread: threading.Thread | None = None
+_http_session: requests.Session | None = None # Shared keep-alive HTTP session (Supervisor API)
 initial_setup_done = False
 
 # Variables for dynamic interval logic
-last_known_update_times: dict[str, str] = {} # Stores the last Update_time (ISO UTC string) per SN
+last_known_update_times: dict[str, int] = {} # Stores the last Update_time (epoch seconds) per SN
 last_data_change_timestamp: float | None = None # Monotonic time of the last data change detected
-using_extended_interval: bool = False # Flag indicating if the extended interval is active
+consecutive_idle_cycles: int = 0 # Idle cycles past the inactivity threshold; each one doubles the interval
 last_plant_data = None
+
+# Variables for failure backoff
+_consecutive_failures = 0 # Consecutive login/WebDriver failures
+_next_retry_at = 0.0 # Monotonic time before which run_cycle skips WebDriver work
+_last_driver_check = 0.0 # Monotonic time the WebDriver was last known to be responsive
 # --- End Global State ---
 
 _LOGGER = logging.getLogger(__name__)
 
+def diagnostics_enabled() -> bool:
+    """Startup diagnostics (image, driver and Supervisor info) only run at DEBUG level or with SAJ_DIAG=1."""
+    return _LOGGER.isEnabledFor(logging.DEBUG) or os.environ.get("SAJ_DIAG") == "1"
+
 def log_docker_image_info():
     """Logs information about the Docker image and base system."""
+    if not diagnostics_enabled():
+        return
     _LOGGER.info("--- Docker Image Information ---")
     build_from = os.environ.get("BUILD_FROM", "Not set")
     _LOGGER.info(f"BUILD_FROM: {build_from}")
@@ -82,7 +118,19 @@ def log_docker_image_info():
 
     _LOGGER.info("--- End Docker Image Information ---")
 
+def get_http_session() -> requests.Session:
+    """Returns the shared HTTP session, creating it on first use."""
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+        # No retries: a stuck Supervisor must not stall startup
+        _http_session.mount("http://", HTTPAdapter(max_retries=0))
+    return _http_session
+
 def log_supervisor_info():
+    """Logs the Supervisor info returned by the Supervisor API."""
+    if not diagnostics_enabled():
+        return
     supervisor_token = os.environ.get("SUPERVISOR_TOKEN")
     if not supervisor_token:
         _LOGGER.error("SUPERVISOR_TOKEN is not set. Cannot fetch Supervisor info.")
@@ -90,7 +138,7 @@ def log_supervisor_info():
 
     headers = {"Authorization": f"Bearer {supervisor_token}"}
     try:
-        response = requests.get("http://supervisor/info", headers=headers)
+        response = get_http_session().get("http://supervisor/info", headers=headers, timeout=SUPERVISOR_TIMEOUT)
         response.raise_for_status()
         data = response.json().get("data", {})
         _LOGGER.info(f"Supervisor Info: {data}")
@@ -98,52 +146,49 @@ def log_supervisor_info():
         _LOGGER.error(f"Error fetching Supervisor info: {e}")
 
 # --- Function to Log Driver Versions ---
-def log_driver_versions():
-    """Logs the versions of Firefox and Geckodriver found."""
-    _LOGGER.info("--- Checking WebDriver Component Versions ---")
-
-    # Check Firefox Version
+def _probe_version(path: str, label: str) -> list[str] | None:
+    """Runs '<path> --version' and returns its output lines, or None (after logging why) if that fails."""
     try:
-        if os.path.exists(FIREFOX_BINARY_PATH):
-            result = subprocess.run(
-                [FIREFOX_BINARY_PATH, '--version'],
-                capture_output=True, text=True, check=True, encoding='utf-8'
-            )
-            # Pega a primeira linha da saída, que geralmente contém a versão
-            version_line = result.stdout.strip().splitlines()[0]
-            _LOGGER.info(f"Firefox Version ({FIREFOX_BINARY_PATH}): {version_line}")
-        else:
-            _LOGGER.warning(f"Firefox binary not found at specified path: {FIREFOX_BINARY_PATH}")
+        if not os.path.exists(path):
+            _LOGGER.warning(f"{label} binary not found at specified path: {path}")
+            return None
+        result = subprocess.run(
+            [path, '--version'],
+            capture_output=True, text=True, check=True, encoding='utf-8', timeout=5
+        )
+        return result.stdout.strip().splitlines()
     except FileNotFoundError:
-         _LOGGER.error(f"Firefox command '{FIREFOX_BINARY_PATH}' not found in the system.")
+        _LOGGER.error(f"{label} command '{path}' not found in the system.")
+    except subprocess.TimeoutExpired:
+        _LOGGER.error(f"{label} version check timed out.")
     except subprocess.CalledProcessError as e:
-        _LOGGER.error(f"Failed to get Firefox version. Command failed: {e}")
+        _LOGGER.error(f"Failed to get {label} version. Command failed: {e}")
         if e.stderr: _LOGGER.error(f"Stderr: {e.stderr.strip()}")
     except Exception as e:
-        _LOGGER.error(f"An unexpected error occurred while checking Firefox version: {e}", exc_info=True)
+        _LOGGER.error(f"An unexpected error occurred while checking {label} version: {e}", exc_info=True)
+    return None
 
-    # Check Geckodriver Version
-    try:
-        if os.path.exists(GECKODRIVER_PATH):
-            result = subprocess.run(
-                [GECKODRIVER_PATH, '--version'],
-                capture_output=True, text=True, check=True, encoding='utf-8'
-            )
-            # Geckodriver pode ter múltiplas linhas, a primeira geralmente tem a versão dele
-            version_line = result.stdout.strip().splitlines()[0]
-            _LOGGER.info(f"Geckodriver Version ({GECKODRIVER_PATH}): {version_line}")
-            # Logar também a segunda linha se existir (pode conter info do Firefox compatível)
-            if len(result.stdout.strip().splitlines()) > 1:
-                 _LOGGER.info(f"Geckodriver Info Line 2: {result.stdout.strip().splitlines()[1]}")
-        else:
-             _LOGGER.warning(f"Geckodriver binary not found at specified path: {GECKODRIVER_PATH}")
-    except FileNotFoundError:
-         _LOGGER.error(f"Geckodriver command '{GECKODRIVER_PATH}' not found in the system.")
-    except subprocess.CalledProcessError as e:
-        _LOGGER.error(f"Failed to get Geckodriver version. Command failed: {e}")
-        if e.stderr: _LOGGER.error(f"Stderr: {e.stderr.strip()}")
-    except Exception as e:
-        _LOGGER.error(f"An unexpected error occurred while checking Geckodriver version: {e}", exc_info=True)
+def log_driver_versions():
+    """Logs the versions of Firefox and Geckodriver found."""
+    if not diagnostics_enabled():
+        return
+    _LOGGER.info("--- Checking WebDriver Component Versions ---")
+
+    # Both probes fork+exec a binary; run them side by side
+    with ThreadPoolExecutor(max_workers=2, initializer=utils.block_shutdown_signals) as executor:
+        firefox_probe = executor.submit(_probe_version, FIREFOX_BINARY_PATH, "Firefox")
+        geckodriver_probe = executor.submit(_probe_version, GECKODRIVER_PATH, "Geckodriver")
+        firefox_lines = firefox_probe.result()
+        geckodriver_lines = geckodriver_probe.result()
+
+    # The first line of the output usually holds the version
+    if firefox_lines:
+        _LOGGER.info(f"Firefox Version ({FIREFOX_BINARY_PATH}): {firefox_lines[0]}")
+    if geckodriver_lines:
+        _LOGGER.info(f"Geckodriver Version ({GECKODRIVER_PATH}): {geckodriver_lines[0]}")
+        # The second line, if present, may hold info about the compatible Firefox
+        if len(geckodriver_lines) > 1:
+             _LOGGER.info(f"Geckodriver Info Line 2: {geckodriver_lines[1]}")
 
     _LOGGER.info("--- Finished Checking WebDriver Component Versions ---")
 # --- End Function to Log Driver Versions ---
@@ -151,36 +196,36 @@ def log_driver_versions():
 # --- Function to Log Environment Info ---
 def log_environment_info():
     """Logs Home Assistant environment information and Docker context."""
-    _LOGGER.debug("--- Home Assistant Environment Information (DEBUG) ---")
-    _LOGGER.debug(f"Env Var 'SUPERVISOR_VERSION': {os.environ.get('SUPERVISOR_VERSION', 'Not Set/Unavailable')}")
-    _LOGGER.debug(f"Env Var 'SUPERVISOR_ARCH': {os.environ.get('SUPERVISOR_ARCH', 'Not Set/Unavailable')}")
-    _LOGGER.debug(f"Env Var 'SUPERVISOR_MACHINE': {os.environ.get('SUPERVISOR_MACHINE', 'Not Set/Unavailable')}")
-    _LOGGER.debug(f"Env Var 'SUPERVISOR_HOSTNAME': {os.environ.get('SUPERVISOR_HOSTNAME', 'Not Set/Unavailable')}")
-    _LOGGER.debug(f"Env Var 'SUPERVISOR_TOKEN': {os.environ.get('SUPERVISOR_HOSTNAME', 'Not Set/Unavailable')}")
-    _LOGGER.debug(f"Env Var 'TZ': {os.environ.get('TZ', 'Not Set/Unavailable')}")
-    _LOGGER.debug(f"Running in Docker: {is_running_in_docker()}")
-    _LOGGER.debug(f"Current PID: {os.getpid()}")
-    _LOGGER.debug(f"Current working directory: {os.getcwd()}")
-    _LOGGER.debug(f"Contents of root directory: {os.listdir('/')}")
-    for key, value in os.environ.items():
-        _LOGGER.debug(f"Env Var '{key}': {value}")
-
-    _LOGGER.debug("--- End Home Assistant Environment Information ---")
-
+    # Everything below is DEBUG output, and some of it (listdir, full environ) costs syscalls to build
+    if not _LOGGER.isEnabledFor(logging.DEBUG):
+        return
+    # Built as one string and logged in a single call rather than one record per line
+    lines = ["--- Home Assistant Environment Information (DEBUG) ---"]
+    lines += [
+        f"Env Var '{key}': {os.environ.get(key, 'Not Set/Unavailable')}"
+        for key in ("SUPERVISOR_VERSION", "SUPERVISOR_ARCH", "SUPERVISOR_MACHINE", "SUPERVISOR_HOSTNAME", "TZ")
+    ]
+    lines.append(f"Running in Docker: {is_running_in_docker()}")
+    lines.append(f"Current PID: {os.getpid()}")
+    lines.append(f"Current working directory: {os.getcwd()}")
+    lines.append(f"Contents of root directory: {sorted(os.listdir('/'))}")
+    lines += [f"Env Var '{key}': {value}" for key, value in sorted(os.environ.items())]
+    lines.append("--- End Home Assistant Environment Information ---")
+    _LOGGER.debug("\n".join(lines))
+
+@lru_cache(maxsize=1)
 def is_running_in_docker():
-    """Check if the script is running inside a Docker container."""
+    """Check if the script is running inside a Docker container. Cached, the answer can't change while running."""
     try:
-        exists = os.path.exists('/.dockerenv')
-        _LOGGER.debug(f"Checking for /.dockerenv: Exists={exists}, Current PID: {os.getpid()}, Current Working Directory: {os.getcwd()}")
-        return exists
+        return os.path.exists('/.dockerenv')
     except Exception as e:
         _LOGGER.error(f"Error checking for /.dockerenv: {e}", exc_info=True)
         return False
 
 def handle_shutdown(signum, frame):
-    global shutdown_requested
     _LOGGER.info(f"Received signal {signum}. Requesting shutdown...")
-    shutdown_requested = True
+    _shutdown_event.set()
+    _cycle_wakeup.set()
 
 
 
@@ -199,8 +244,8 @@ def load_config():
     global CONFIG
     _LOGGER.info(f"Loading configuration from {OPTIONS_FILE}")
     try:
-        with open(OPTIONS_FILE, 'r') as f:
-            CONFIG = json.load(f)
+        with open(OPTIONS_FILE, 'rb') as f:
+            CONFIG = utils.json_loads(f.read())
             log_level = CONFIG.get("log_level", DEFAULT_LOG_LEVEL).upper()
             logging.getLogger().setLevel(log_level)
             _LOGGER.info(f"Configuration loaded successfully. Log level set to {log_level}")
@@ -218,7 +263,13 @@ def load_config():
             if not CONFIG.get("microinverters"):
                  _LOGGER.warning(f"Microinverters list missing in config. Consider using the default: {DEFAULT_MICROINVERTERS}")
 
-            # Load dynamic interval settings, ensuring they are integers
+            # Load interval settings, ensuring they are integers
+            try:
+                CONFIG["update_interval_seconds"] = int(CONFIG.get("update_interval_seconds", UPDATE_INTERVAL))
+            except (ValueError, TypeError):
+                _LOGGER.warning(f"Invalid value for update_interval_seconds, using default: {UPDATE_INTERVAL}s")
+                CONFIG["update_interval_seconds"] = UPDATE_INTERVAL
+
             try:
                 CONFIG[CONF_DATA_INACTIVITY_THRESHOLD] = int(CONFIG.get(CONF_DATA_INACTIVITY_THRESHOLD, DEFAULT_DATA_INACTIVITY_THRESHOLD))
             except (ValueError, TypeError):
@@ -234,6 +285,9 @@ def load_config():
             _LOGGER.info(f"Data inactivity threshold set to {CONFIG[CONF_DATA_INACTIVITY_THRESHOLD]} seconds.")
             _LOGGER.info(f"Extended update interval set to {CONFIG[CONF_EXTENDED_UPDATE_INTERVAL]} seconds.")
 
+            # Parse the inactivity window once instead of on every cycle
+            utils.preparse_inactivity_window(CONFIG)
+
     except FileNotFoundError:
         _LOGGER.error(f"Configuration file {OPTIONS_FILE} not found. Cannot start.")
         sys.exit(1)
@@ -244,9 +298,82 @@ def load_config():
     ADDON_VERSION = get_addon_version_from_config()
     _LOGGER.info(f"Add-on version: {ADDON_VERSION}")
 
+def flush_peak_power_state(force: bool = False):
+    """Queues the peak power state for writing if it changed, at most every PEAK_STATE_FLUSH_INTERVAL seconds unless forced."""
+    global _peak_dirty, _peak_last_flush
+    if not _peak_dirty:
+        return
+    if not force and time.monotonic() - _peak_last_flush < PEAK_STATE_FLUSH_INTERVAL:
+        _LOGGER.debug("Peak power state changed. Deferring write to disk.")
+        return
+    _queue_peak_power_state((current_peak_power, last_reset_date))
+    _peak_dirty = False
+    _peak_last_flush = time.monotonic()
+
+def _peak_state_writer():
+    """Background thread writing queued peak power states to disk until it receives None."""
+    while True:
+        state = _persist_queue.get()
+        if state is None:
+            return
+        try:
+            persistence.save_peak_power_state(*state)
+        except Exception as e:
+            _LOGGER.error(f"Unexpected error saving peak power state: {e}", exc_info=True)
+
+def _queue_peak_power_state(state):
+    """Hands a state to the writer thread, replacing one that is still waiting, so bursts collapse into one write."""
+    global _persist_thread
+    with _persist_lock:
+        if _persist_thread is None:
+            _persist_thread = threading.Thread(target=_peak_state_writer, name="peak_state_writer", daemon=True)
+            with utils.shutdown_signals_blocked():
+                _persist_thread.start()
+        try:
+            _persist_queue.get_nowait()
+        except queue.Empty:
+            pass
+        _persist_queue.put_nowait(state)
+
+def stop_peak_state_writer(timeout: float = 5):
+    """Lets the writer thread finish the queued state, then stops it."""
+    global _persist_thread
+    with _persist_lock:
+        if _persist_thread is None:
+            return
+        _persist_queue.put(None) # Blocks until a pending state has been picked up, so it's not dropped
+        thread, _persist_thread = _persist_thread, None
+    thread.join(timeout)
+
+def publish_availability_heartbeat():
+    """Re-publishes the online status if MQTT_AVAILABILITY_HEARTBEAT_INTERVAL has passed since the last one."""
+    global _last_availability_publish
+    if mqtt_client and time.monotonic() - _last_availability_publish >= MQTT_AVAILABILITY_HEARTBEAT_INTERVAL:
+        mqtt_utils.publish_availability(mqtt_client)
+        _last_availability_publish = time.monotonic()
+
+def wait_for_cycle(cycle: Future) -> bool:
+    """Waits for a cycle running in the worker thread, keeping the availability heartbeat going meanwhile.
+    Returns False if shutdown was requested before the cycle finished."""
+    cycle.add_done_callback(lambda _: _cycle_wakeup.set())
+    while True:
+        _cycle_wakeup.clear()
+        if cycle.done():
+            cycle.result() # Re-raise anything run_cycle didn't handle
+            return True
+        if _shutdown_event.is_set():
+            return False
+        if not _cycle_wakeup.wait(timeout=MQTT_AVAILABILITY_HEARTBEAT_INTERVAL):
+            publish_availability_heartbeat()
+
 def cleanup():
-    global mqtt_client, webdriver
+    global mqtt_client, webdriver, _http_session
     _LOGGER.info("Performing cleanup...")
+    flush_peak_power_state(force=True)
+    stop_peak_state_writer()
+    if _http_session:
+        _http_session.close()
+        _http_session = None
     if mqtt_client:
         try:
             _LOGGER.info("Publishing offline status to MQTT...")
@@ -270,17 +397,50 @@ def cleanup():
     _LOGGER.info("Cleanup finished.")
 
 
+@lru_cache(maxsize=1024)
+def _update_time_epoch(update_time: str | None) -> int | None:
+    """Converts an ISO UTC Update_time string ('...Z') to epoch seconds. Returns None if missing or invalid."""
+    if not isinstance(update_time, str) or not update_time.endswith("Z"):
+        return None
+    try:
+        return int(datetime.fromisoformat(update_time[:-1] + "+00:00").timestamp())
+    except ValueError:
+        return None
+
+def is_inactive_cached() -> bool:
+    """utils.is_inactive, re-evaluated only once the inactivity period starts or ends (at least hourly)."""
+    global _inactive_cache
+    now = time.monotonic()
+    if _inactive_cache is not None and now < _inactive_cache[0]:
+        return _inactive_cache[1]
+    # Boundary first: if it passes while is_inactive runs, the cache simply expires right away
+    seconds_left = utils.seconds_until_inactivity_boundary(CONFIG)
+    inactive = utils.is_inactive(CONFIG)
+    _inactive_cache = (now + min(seconds_left, 3600), inactive) if seconds_left is not None else None
+    return inactive
+
+def _register_failure():
+    """Schedules the next WebDriver attempt with exponential backoff and jitter."""
+    global _consecutive_failures, _next_retry_at
+    _consecutive_failures += 1
+    delay = min(FAILURE_BACKOFF_MAX, FAILURE_BACKOFF_BASE * 2 ** (_consecutive_failures - 1)) + random.uniform(0, FAILURE_BACKOFF_BASE)
+    _next_retry_at = time.monotonic() + delay
+    _LOGGER.info(f"{_consecutive_failures} consecutive failure(s). Backing off for {delay:.0f} seconds before the next attempt.")
+
 def run_cycle():
      global webdriver, current_peak_power, last_reset_date, mqtt_client, initial_setup_done
-     global last_known_update_times, last_data_change_timestamp, using_extended_interval, last_plant_data
+     global last_known_update_times, last_data_change_timestamp, consecutive_idle_cycles, last_plant_data
+     global _consecutive_failures, _peak_dirty, _last_driver_check
 
      # High priority check: Configured inactivity period
-     if initial_setup_done and utils.is_inactive(CONFIG):
+     if initial_setup_done and is_inactive_cached():
          _LOGGER.info("Currently in configured inactivity period. Skipping data fetch cycle.")
-         # Reset extended interval flag if entering the main inactivity period
-         if using_extended_interval:
-             _LOGGER.info("Resetting extended interval flag due to entering inactivity period.")
-             using_extended_interval = False
+         # The idle backoff keeps growing through the period, so nights are polled at the extended interval
+         return
+
+     # Back off after repeated login/WebDriver failures
+     if time.monotonic() < _next_retry_at:
+         _LOGGER.info("Backing off after previous failures. Next attempt in %.0f seconds.", _next_retry_at - time.monotonic())
          return
 
     # force_relogin = False
@@ -291,28 +451,49 @@ def run_cycle():
        #webdriver.quit()
        #webdriver = None
 
-     # Ensure WebDriver is running
-     if not webdriver or not web_scraper._is_driver_connected(webdriver):
+     # Ensure WebDriver is running. A live session is only pinged once per health check interval;
+     # in between, a dead session surfaces as a fetch error and is handled below
+     driver_alive = webdriver is not None
+     if driver_alive and time.monotonic() - _last_driver_check >= WEBDRIVER_HEALTH_CHECK_INTERVAL:
+         driver_alive = web_scraper._is_driver_connected(webdriver)
+         if driver_alive:
+             _last_driver_check = time.monotonic()
+     if not driver_alive:
          try:
              _LOGGER.info("WebDriver not active. Attempting to validate connection and log in...")
              webdriver = web_scraper.validate_connection(CONFIG)
              _LOGGER.info("Connection validated and logged in successfully.")
+             _last_driver_check = time.monotonic()
          except (ValueError, RuntimeError, Exception) as e:
-             _LOGGER.error(f"Failed to establish WebDriver connection or log in: {e}. Will retry next cycle.")
+             _LOGGER.error(f"Failed to establish WebDriver connection or log in: {e}. Will retry later.")
              cleanup_webdriver()
              webdriver = None
+             _register_failure()
              return
 
      # Fetch Data
      try:
-         _LOGGER.info("Fetching microinverter data...")
+         _LOGGER.debug("Fetching microinverter data...")
+         fetch_started = time.perf_counter()
+         aggregate_ms = publish_ms = 0.0
+         published = False
          # Força re-login ao sair da inatividade
          force_relogin = False
-         if not using_extended_interval and getattr(run_cycle, "_last_cycle_was_extended", False):
+         if consecutive_idle_cycles == 0 and getattr(run_cycle, "_last_cycle_was_extended", False):
              _LOGGER.info("Detected return from inactivity/extended interval. Forcing re-login.")
              force_relogin = True
-         device_data = web_scraper._fetch_data_sync(CONFIG, webdriver, force_relogin=force_relogin)
-         run_cycle._last_cycle_was_extended = using_extended_interval
+         device_data, webdriver = web_scraper._fetch_data_sync(CONFIG, webdriver, force_relogin=force_relogin, stop_event=_shutdown_event)
+         if _shutdown_event.is_set():
+             _LOGGER.info("Shutdown requested. Discarding the rest of this cycle.")
+             return
+         run_cycle._last_cycle_was_extended = consecutive_idle_cycles > 0
+         _consecutive_failures = 0
+         if device_data:
+             _last_driver_check = time.monotonic() # A device read proves the session is alive
+         else:
+             # _fetch_data_sync swallows per-device errors, so an empty result may be a dead driver: ping it next cycle
+             _last_driver_check = 0.0
+         fetch_ms = (time.perf_counter() - fetch_started) * 1000
 
          if not device_data:
              _LOGGER.warning("No device data fetched in this cycle.")
@@ -320,57 +501,69 @@ def run_cycle():
              return
 
          plant_data = None
+         first_publish = not initial_setup_done
 
          # Check for data changes (only after initial setup)
          data_changed_this_cycle = False
+         peak_state_changed = False
          if initial_setup_done:
+            # Local aliases for the per-device loop
+            known_update_times = last_known_update_times
+            update_time_epoch = _update_time_epoch
+            changed_sns = []
             for sn, data in device_data.items():
                  current_update_time = data.get("Update_time") # Should be ISO UTC string
-                 previous_update_time = last_known_update_times.get(sn)
-
-                 if current_update_time and isinstance(current_update_time, str) and 'Z' in current_update_time:
-                     if current_update_time != previous_update_time:
-                         _LOGGER.debug(f"New data detected for device {sn}: Update_time changed from '{previous_update_time}' to '{current_update_time}'")
-                         last_known_update_times[sn] = current_update_time
-                         data_changed_this_cycle = True
-                     else:
-                          _LOGGER.debug(f"No new data for device {sn}: Update_time ('{current_update_time}') is unchanged.")
-                 else:
-                      _LOGGER.warning(f"Could not check data change for device {sn}: Invalid or missing Update_time ('{current_update_time}')")
+                 current_epoch = update_time_epoch(current_update_time)
+                 if current_epoch is None:
+                      _LOGGER.warning("Could not check data change for device %s: Invalid or missing Update_time ('%s')", sn, current_update_time)
+                      continue
+
+                 previous_epoch = known_update_times.get(sn)
+                 if current_epoch != previous_epoch:
+                     if previous_epoch is not None and current_epoch < previous_epoch:
+                         _LOGGER.warning("Update_time for device %s went backwards (%s). Portal clock skew?", sn, current_update_time)
+                     known_update_times[sn] = current_epoch
+                     changed_sns.append(sn)
+
+            data_changed_this_cycle = bool(changed_sns)
+            _LOGGER.debug("Devices with new data: %s (unchanged: %d)", changed_sns, len(device_data) - len(changed_sns))
+
+            # Forget devices that are no longer returned (e.g. removed from the configuration)
+            for sn in known_update_times.keys() - device_data.keys():
+                 _LOGGER.debug("Device %s not in fetched data. Dropping its last known update time.", sn)
+                 del known_update_times[sn]
 
             if data_changed_this_cycle:
                  _LOGGER.debug("Data changed in this cycle. Updating last change timestamp.")
                  last_data_change_timestamp = time.monotonic()
 
-                 if using_extended_interval:
+                 if consecutive_idle_cycles:
                      _LOGGER.info("New data detected. Switching back to normal update interval.")
-                     using_extended_interval = False
+                     consecutive_idle_cycles = 0
 
                  # Aggregate Data e calcula apenas se houve novidade
-                 _LOGGER.info("Aggregating plant data...")
+                 _LOGGER.debug("Aggregating plant data...")
+                 aggregate_started = time.perf_counter()
                  plant_data = utils.aggregate_plant_data(device_data)
                  last_plant_data = plant_data
 
                  # Calculate Peak Power
-                 _LOGGER.info("Calculating peak power...")
-                 current_plant_power_str = plant_data.get("Power")
-                 current_plant_power = None
-                 if current_plant_power_str is not None:
-                     try:
-                         current_plant_power = float(str(current_plant_power_str).replace(',', '.'))
-                     except (ValueError, TypeError):
-                         _LOGGER.warning(f"Could not convert current plant power '{current_plant_power_str}' to float.")
+                 _LOGGER.debug("Calculating peak power...")
+                 current_plant_power = plant_data.get("Power") # Already a float (or None if nothing was aggregated)
 
                  new_peak, new_reset_date, peak_state_changed = utils.calculate_peak_power(
                      current_plant_power, current_peak_power, last_reset_date
                  )
 
-                 # Persist Peak Power State (if changed)
+                 # Persist Peak Power State (if changed). A new day is written right away, intra-day peaks are coalesced
                  if peak_state_changed:
-                     _LOGGER.info(f"Peak power state changed. New Peak: {new_peak:.2f}, Reset Date: {new_reset_date}")
+                     _LOGGER.info("Peak power state changed. New Peak: %.2f, Reset Date: %s", new_peak, new_reset_date)
+                     reset_date_changed = new_reset_date != last_reset_date
                      current_peak_power = new_peak
                      last_reset_date = new_reset_date
-                     persistence.save_peak_power_state(current_peak_power, last_reset_date)
+                     _peak_dirty = True
+                     flush_peak_power_state(force=reset_date_changed)
+                 aggregate_ms = (time.perf_counter() - aggregate_started) * 1000
 
             else:
                  _LOGGER.debug("No data changed across all devices in this cycle.")
@@ -385,8 +578,8 @@ def run_cycle():
          #    plant_data = last_plant_data
 
          # Publish to MQTT
-         if mqtt_client and mqtt_client.is_connected():
-              _LOGGER.info("Publishing data to MQTT...")
+         if mqtt_client and getattr(mqtt_client, "_saj_connected", False): # Same connection state as publish_state
+              _LOGGER.debug("Publishing data to MQTT...")
 
               # Conditional Discovery (only on first successful fetch)
               if not initial_setup_done:
@@ -395,46 +588,66 @@ def run_cycle():
                     if plant_data is None:
                         plant_data = utils.aggregate_plant_data(device_data)
                         last_plant_data = plant_data
-                    mqtt_utils.publish_discovery(mqtt_client, device_data, plant_data, {"value": current_peak_power, "last_reset_date": last_reset_date}, ADDON_VERSION)
+                    mqtt_utils.publish_discovery(mqtt_client, device_data, plant_data, {"value": current_peak_power, "last_reset_date": last_reset_date}, ADDON_VERSION, ack_timeout=5)
                     _LOGGER.info("Initial MQTT discovery published successfully.")
 
-                    _LOGGER.info("Waiting 5 seconds for Home Assistant to process discovery...")
-                    time.sleep(5) # Adjust delay if needed
-
                     initial_setup_done = True
                     # Initialize timestamps after first successful discovery
                     _LOGGER.debug("Initializing last known update times and change timestamp.")
                     last_data_change_timestamp = time.monotonic()
                     for sn, data in device_data.items():
-                        update_time = data.get("Update_time")
-                        if update_time and isinstance(update_time, str) and 'Z' in update_time:
-                            last_known_update_times[sn] = update_time
+                        update_epoch = _update_time_epoch(data.get("Update_time"))
+                        if update_epoch is not None:
+                            last_known_update_times[sn] = update_epoch
                 except Exception as discovery_err:
                     _LOGGER.error(f"Failed to publish initial MQTT discovery: {discovery_err}", exc_info=True)
                     # Abort cycle if initial discovery fails, prevents publishing state
                     return
 
-              # Publish current state (only if initial setup is complete)
+              # Publish current state (only if initial setup is complete). Unchanged data is not
+              # republished: state topics are retained, so the broker already holds the latest values
               if initial_setup_done:
-                  try:
-                      mqtt_utils.publish_state(mqtt_client, device_data, plant_data, current_peak_power, last_reset_date)
-                      _LOGGER.info("Data state published successfully.")
-                  except Exception as state_pub_err:
-                       _LOGGER.error(f"Failed to publish state: {state_pub_err}", exc_info=True)
+                  should_publish = first_publish or data_changed_this_cycle or peak_state_changed or not mqtt_utils.has_published_state()
+                  if not should_publish:
+                      _LOGGER.debug("No new data since last publish. Skipping state publish.")
+                  else:
+                      try:
+                          publish_started = time.perf_counter()
+                          mqtt_utils.publish_state(mqtt_client, device_data, plant_data, current_peak_power, last_reset_date, state_qos=0)
+                          publish_ms = (time.perf_counter() - publish_started) * 1000
+                          published = True
+                          _LOGGER.debug("Data state published successfully.")
+                      except Exception as state_pub_err:
+                           _LOGGER.error(f"Failed to publish state: {state_pub_err}", exc_info=True)
 
          else:
-              _LOGGER.warning("MQTT client not connected. Cannot publish data.")
+              # paho reconnects an existing client in its network thread; the state is queued and sent once it's back
+              _LOGGER.warning("MQTT client not connected. Cannot publish data now.")
               if not mqtt_client:
-                   _LOGGER.info("Attempting to reconnect MQTT...")
-                   mqtt_client = mqtt_utils.connect_mqtt(f"saj-portal-addon-{os.getpid()}", CONFIG)
+                   _LOGGER.info("Attempting to create MQTT client...")
+                   mqtt_client = mqtt_utils.connect_mqtt(CLIENT_ID, CONFIG, wait_timeout=0)
+              elif initial_setup_done:
+                   mqtt_utils.publish_state(mqtt_client, device_data, plant_data, current_peak_power, last_reset_date, state_qos=0)
+
+         # One summary line per cycle; the per-stage messages above are DEBUG only
+         _LOGGER.info(
+             "Cycle done: devices=%d changed=%s published=%s fetch=%.0fms aggregate=%.0fms publish=%.0fms",
+             len(device_data), data_changed_this_cycle or first_publish, published, fetch_ms, aggregate_ms, publish_ms,
+         )
 
      # Error Handling
      except ValueError as e: # Typically login/config errors
           _LOGGER.error(f"Authentication or configuration error during cycle: {e}")
           cleanup_webdriver()
+          _register_failure()
      except (web_scraper.WebDriverException, web_scraper.TimeoutException) as e: # Selenium errors
           _LOGGER.error(f"Selenium error during data fetch: {e}. WebDriver might be stale.")
-          cleanup_webdriver()
+          # Try a cheap refresh before paying for a full Firefox restart and re-login
+          if webdriver and web_scraper.try_refresh_driver(webdriver):
+              _LOGGER.info("WebDriver responsive after refresh. Keeping the current session.")
+          else:
+              cleanup_webdriver()
+              _register_failure()
      except Exception as e: # Unexpected errors
          _LOGGER.exception(f"Unexpected error during processing cycle: {e}")
 
@@ -456,43 +669,47 @@ if __name__ == "__main__":
     # Load configuration
     load_config()
 
-   # Only log Docker, driver, and supervisor info if log level is DEBUG or lower (more verbose)
-    log_level = logging.getLogger().getEffectiveLevel()
-    if log_level <= logging.DEBUG:
-        log_docker_image_info()
-        log_driver_versions()
-        log_supervisor_info()
+    # Docker, driver, and supervisor info are diagnostics: DEBUG level (set by load_config) or SAJ_DIAG=1 only
+    log_docker_image_info()
+    log_driver_versions()
+    log_supervisor_info()
 
-    current_peak_power, last_reset_date = persistence.load_peak_power_state()
+    # Page source dumps from failed fetches accumulate in /data; drop the old ones
+    web_scraper.cleanup_debug_dumps()
 
-    client_id = f"{DOMAIN}-addon-{os.getpid()}"
+    current_peak_power, last_reset_date = persistence.load_peak_power_state()
 
-    mqtt_client = mqtt_utils.connect_mqtt(client_id, CONFIG)
+    mqtt_client = mqtt_utils.connect_mqtt(CLIENT_ID, CONFIG)
     if not mqtt_client:
-        _LOGGER.warning("Initial MQTT connection failed. Will retry within the loop.")
+        _LOGGER.warning("Initial MQTT client setup failed. Will retry within the loop.")
 
     # --- ADDED: Log HA environment details if log level is DEBUG ---
     if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
         log_environment_info()
 
-    # Get intervals from config
-    normal_update_interval = CONFIG.get("update_interval_seconds", UPDATE_INTERVAL)
-    data_inactivity_threshold = CONFIG.get(CONF_DATA_INACTIVITY_THRESHOLD, DEFAULT_DATA_INACTIVITY_THRESHOLD)
-    extended_update_interval = CONFIG.get(CONF_EXTENDED_UPDATE_INTERVAL, DEFAULT_EXTENDED_UPDATE_INTERVAL)
+    # Intervals as validated (coerced to int) by load_config
+    normal_update_interval = CONFIG["update_interval_seconds"]
+    data_inactivity_threshold = CONFIG[CONF_DATA_INACTIVITY_THRESHOLD]
+    extended_update_interval = CONFIG[CONF_EXTENDED_UPDATE_INTERVAL]
     _LOGGER.info(f"Normal update interval set to {normal_update_interval} seconds.")
+    current_interval_to_use = normal_update_interval
+    cycle: Future | None = None # Cycle currently submitted to _cycle_executor
+    _last_availability_publish = time.monotonic() # connect_mqtt publishes "online" on connect
 
     # Main loop
-    while not shutdown_requested:
+    while not _shutdown_event.is_set():
         try:
             start_time = time.monotonic()
             if not initial_setup_done:
                  _LOGGER.info("Starting initial data fetch and discovery cycle attempt...")
             else:
                  # Log which interval is currently active
-                 current_interval_in_use = extended_update_interval if using_extended_interval else normal_update_interval
-                 _LOGGER.info(f"Starting new data fetch cycle (Interval: {current_interval_in_use}s {'[Extended]' if using_extended_interval else '[Normal]'})")
+                 _LOGGER.info(f"Starting new data fetch cycle (Interval: {current_interval_to_use}s {'[Extended]' if consecutive_idle_cycles else '[Normal]'})")
 
-            run_cycle()
+            # Fetching runs in a worker thread, so a slow portal doesn't starve the heartbeat or delay shutdown
+            cycle = _cycle_executor.submit(run_cycle)
+            if not wait_for_cycle(cycle):
+                break
 
             end_time = time.monotonic()
             duration = end_time - start_time
@@ -502,34 +719,44 @@ if __name__ == "__main__":
             current_interval_to_use = normal_update_interval
 
             if initial_setup_done: # Only apply dynamic logic after setup
-                # Check if we should switch TO extended interval
-                if not using_extended_interval and last_data_change_timestamp is not None:
+                # Past the inactivity threshold, every cycle without new data doubles the interval
+                if last_data_change_timestamp is not None:
                     time_since_last_change = time.monotonic() - last_data_change_timestamp
-                    _LOGGER.debug(f"Time since last data change: {time_since_last_change:.0f}s (Threshold: {data_inactivity_threshold}s)")
+                    _LOGGER.debug("Time since last data change: %.0fs (Threshold: %ss)", time_since_last_change, data_inactivity_threshold)
                     if time_since_last_change > data_inactivity_threshold:
-                        _LOGGER.info(f"Data inactivity threshold ({data_inactivity_threshold}s) exceeded. Switching to extended interval ({extended_update_interval}s).")
-                        using_extended_interval = True
+                        consecutive_idle_cycles = min(consecutive_idle_cycles + 1, IDLE_BACKOFF_MAX_DOUBLINGS)
+
+                # Step up from the normal interval, capped by the extended interval
+                if consecutive_idle_cycles:
+                    current_interval_to_use = min(extended_update_interval, normal_update_interval * 2 ** consecutive_idle_cycles)
+                    _LOGGER.debug("No new data for %d idle cycle(s). Interval raised to %ss.", consecutive_idle_cycles, current_interval_to_use)
+
+            # Write a deferred peak power change once its flush interval has passed
+            flush_peak_power_state()
 
-                # Use extended interval if the flag is set
-                if using_extended_interval:
-                    current_interval_to_use = extended_update_interval
+            # Availability heartbeat, independent of whether state was published this cycle
+            publish_availability_heartbeat()
 
             # Calculate sleep time
             sleep_time = max(0, current_interval_to_use - duration)
-            _LOGGER.info(f"Sleeping for {sleep_time:.2f} seconds (Using {'Extended' if using_extended_interval else 'Normal'} Interval)...")
+            _LOGGER.info(f"Sleeping for {sleep_time:.2f} seconds (Using {'Extended' if consecutive_idle_cycles else 'Normal'} Interval)...")
 
-            # Sleep interruptibly to allow faster shutdown
-            sleep_end_time = time.monotonic() + sleep_time
-            while time.monotonic() < sleep_end_time and not shutdown_requested:
-                 time.sleep(1) # Sleep in 1s increments
+            # Sleep interruptibly: returns as soon as a shutdown signal arrives
+            _shutdown_event.wait(timeout=sleep_time)
 
         except Exception as loop_err:
              _LOGGER.exception(f"Critical error in main loop: {loop_err}")
              # Prevent fast looping on critical errors
-             time.sleep(60)
+             _shutdown_event.wait(timeout=60)
 
     # Shutdown
     _LOGGER.info("Shutdown requested. Exiting main loop.")
+    # An in-flight cycle stops at the next device and skips recovery once _shutdown_event is set;
+    # give it a bounded time to do so, so cleanup() doesn't quit the WebDriver under it
+    if cycle is not None and not cycle.done():
+        _LOGGER.info("Waiting up to %ss for the running cycle to finish...", CYCLE_SHUTDOWN_TIMEOUT)
+        wait_futures([cycle], timeout=CYCLE_SHUTDOWN_TIMEOUT)
+    _cycle_executor.shutdown(wait=False, cancel_futures=True)
     cleanup()
     _LOGGER.info("SAJ Portal Scraper Add-on stopped.")
     sys.exit(0)
@@ -1,6 +1,16 @@
 # /workspaces/addons/saj_portal_scraper/utils.py
+import json
 import logging
-from datetime import datetime, time, date
+import signal
+from contextlib import contextmanager
+from datetime import datetime, time, date, timedelta
+from functools import lru_cache
+
+# orjson is a much faster (de)serializer that works on bytes directly; fall back to stdlib json if unavailable
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from const import (
     CONF_INACTIVITY_ENABLED,
@@ -9,10 +19,82 @@ from const import (
     DEFAULT_INACTIVITY_ENABLED,
     DEFAULT_INACTIVITY_START_TIME,
     DEFAULT_INACTIVITY_END_TIME,
+    CONF_INACTIVITY_START_PARSED,
+    CONF_INACTIVITY_END_PARSED,
 )
 
 _LOGGER = logging.getLogger(__name__)
 
+# --- Signal Masking ---
+# Blocked in helper threads so the kernel always delivers them to the main thread, which is the
+# one waiting on the shutdown event (a signal taken by another thread doesn't interrupt that wait)
+SHUTDOWN_SIGNALS = {signal.SIGINT, signal.SIGTERM}
+
+def block_shutdown_signals():
+    """Blocks SIGINT/SIGTERM in the calling thread. Used as ThreadPoolExecutor initializer."""
+    signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+
+@contextmanager
+def shutdown_signals_blocked():
+    """Blocks SIGINT/SIGTERM for the duration of the block, so threads started inside it inherit the mask."""
+    old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+    try:
+        yield
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+@contextmanager
+def shutdown_signals_unblocked():
+    """Unblocks SIGINT/SIGTERM for the duration of the block. Child processes inherit the signal mask of the
+    thread that starts them, so a helper thread launching geckodriver/Firefox must do so inside this block,
+    or they would ignore the SIGTERM that stops them on quit()."""
+    old_mask = signal.pthread_sigmask(signal.SIG_UNBLOCK, SHUTDOWN_SIGNALS)
+    try:
+        yield
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+def _json_default(obj):
+    """Serializes dates for the stdlib json fallback (orjson handles them natively)."""
+    if isinstance(obj, date):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def json_dumps(obj) -> bytes:
+    """Serializes an object to compact JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), default=_json_default).encode()
+
+def json_loads(data: bytes | str):
+    """Parses JSON from bytes or str. Raises json.JSONDecodeError (or a subclass) on invalid input."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _to_float(value) -> float:
+    """Converts a scraped numeric value ('1,5', '1.5', int or float) to float. Raises ValueError/TypeError if not numeric."""
+    if isinstance(value, float):
+        return value
+    if isinstance(value, str):
+        return float(value.replace(',', '.') if ',' in value else value) # Most portal values already use a dot
+    return float(value)
+
+@lru_cache(maxsize=16)
+def parse_hhmm(value: str) -> time:
+    """Parses an 'HH:MM' string into a datetime.time (cached per string). Raises ValueError on invalid input."""
+    return datetime.strptime(value, "%H:%M").time()
+
+def preparse_inactivity_window(config: dict):
+    """Stores the parsed inactivity start/end times in the config, so is_inactive doesn't parse them every cycle."""
+    try:
+        config[CONF_INACTIVITY_START_PARSED] = parse_hhmm(config.get(CONF_INACTIVITY_START_TIME, DEFAULT_INACTIVITY_START_TIME))
+        config[CONF_INACTIVITY_END_PARSED] = parse_hhmm(config.get(CONF_INACTIVITY_END_TIME, DEFAULT_INACTIVITY_END_TIME))
+    except (ValueError, TypeError):
+        # Left unset: is_inactive parses (and reports) the raw strings itself
+        config.pop(CONF_INACTIVITY_START_PARSED, None)
+        config.pop(CONF_INACTIVITY_END_PARSED, None)
 
 def is_inactive(config: dict) -> bool:
     """Check if the current time falls within the configured inactivity period."""
@@ -26,8 +108,11 @@ def is_inactive(config: dict) -> bool:
     try:
         now_local = datetime.now()
         current_time = now_local.time()
-        start_time = datetime.strptime(start_time_str, "%H:%M").time()
-        end_time = datetime.strptime(end_time_str, "%H:%M").time()
+        start_time = config.get(CONF_INACTIVITY_START_PARSED)
+        end_time = config.get(CONF_INACTIVITY_END_PARSED)
+        if start_time is None or end_time is None: # Not pre-parsed by load_config
+            start_time = parse_hhmm(start_time_str)
+            end_time = parse_hhmm(end_time_str)
 
         _LOGGER.debug(
             "Checking inactivity: Current local time %s, Start %s, End %s",
@@ -59,18 +144,44 @@ def is_inactive(config: dict) -> bool:
     return False
 
 
+def seconds_until_inactivity_boundary(config: dict) -> float | None:
+    """Returns the seconds until the inactivity period next starts or ends, or None if there is no valid (pre-parsed) period."""
+    if not config.get(CONF_INACTIVITY_ENABLED, DEFAULT_INACTIVITY_ENABLED):
+        return None
+    start_time = config.get(CONF_INACTIVITY_START_PARSED)
+    end_time = config.get(CONF_INACTIVITY_END_PARSED)
+    if start_time is None or end_time is None:
+        return None
+
+    now = datetime.now()
+    next_boundary = None
+    for boundary_time in (start_time, end_time):
+        boundary = datetime.combine(now.date(), boundary_time)
+        if boundary <= now:
+            boundary += timedelta(days=1)
+        if next_boundary is None or boundary < next_boundary:
+            next_boundary = boundary
+    return (next_boundary - now).total_seconds()
+
+
+def _parse_utc_timestamp(value: str) -> datetime:
+    """Parses the scraper's 'YYYY-MM-DDTHH:MM:SSZ' Update_time (naive UTC). Raises ValueError/TypeError otherwise."""
+    if not value.endswith("Z"):
+        raise ValueError(f"Not a UTC timestamp: {value!r}")
+    # fromisoformat is implemented in C; strptime re-interprets its format string on every call
+    return datetime.fromisoformat(value[:-1])
+
+# Plant totals: attribute -> slot in the aggregator's sums list. Per-channel "<CH>_Panel_Power" values go to _PANEL_POWER_SLOT
+_SUM_SLOTS = {"Power": 0, "Energy_Today": 1, "Energy_This_Month": 2, "Energy_This_Year": 3, "Energy_Total": 4}
+_PANEL_POWER_SLOT = 5
+
 def aggregate_plant_data(fetched_data: dict | None) -> dict:
     """Aggregate data from all devices into a single plant summary."""
     if not fetched_data:
         _LOGGER.warning("Aggregator: No fetched data provided for aggregation.")
         return {}
 
-    plant_sum_power = 0.0
-    plant_sum_energy_today = 0.0
-    plant_sum_energy_month = 0.0
-    plant_sum_energy_year = 0.0
-    plant_sum_energy_total = 0.0
-    plant_sum_panel_power = 0.0
+    sums = [0.0] * (_PANEL_POWER_SLOT + 1)
     latest_update_time_str: str | None = None
     compare_update_time_obj: datetime | None = None
 
@@ -83,68 +194,41 @@ def aggregate_plant_data(fetched_data: dict | None) -> dict:
 
         try:
             for attribute, value_str in latest_row_data.items():
-                is_summable_numeric = False
-                try:
-                    is_summable_numeric = attribute in [
-                        "Power", "Energy_Today", "Energy_This_Month",
-                        "Energy_This_Year", "Energy_Total"
-                    ] or attribute.endswith("_Panel_Power") # Also sum individual panel powers
-
-                    if is_summable_numeric and value_str is not None:
-                        # Attempt conversion to float, handling commas
-                        value_float = float(str(value_str).replace(',', '.'))
-
-                        if attribute == "Power":
-                            plant_sum_power += value_float
-                        elif attribute == "Energy_Today":
-                            plant_sum_energy_today += value_float
-                        elif attribute == "Energy_This_Month":
-                            plant_sum_energy_month += value_float
-                        elif attribute == "Energy_This_Year":
-                            plant_sum_energy_year += value_float
-                        elif attribute == "Energy_Total":
-                            plant_sum_energy_total += value_float
-                        elif attribute.endswith("_Panel_Power"):
-                             plant_sum_panel_power += value_float
-
-                except (ValueError, TypeError):
-                     if is_summable_numeric:
+                slot = _SUM_SLOTS.get(attribute)
+                if slot is None and attribute.endswith("_Panel_Power"): # Also sum individual panel powers
+                    slot = _PANEL_POWER_SLOT
+                if slot is not None and value_str is not None:
+                    try:
+                        sums[slot] += _to_float(value_str)
+                    except (ValueError, TypeError):
                         _LOGGER.warning(
                             "Aggregator: Could not convert value '%s' to float for summing attribute '%s' in device %s. Skipping value.",
                             value_str, attribute, device_alias
                         )
 
-                # Find the latest timestamp across all devices
-                if attribute == "Update_time" :
-                    if value_str:
-                        try:
-                            # Assumes 'YYYY-MM-DDTHH:MM:SSZ' format from scraper
-                            iso_format_string = "%Y-%m-%dT%H:%M:%SZ"
-                            current_time_obj = datetime.strptime(value_str, iso_format_string)
-
-                            if attribute == "Update_time":
-                                if compare_update_time_obj is None or current_time_obj > compare_update_time_obj:
-                                    compare_update_time_obj = current_time_obj
-                                    latest_update_time_str = value_str
-                        except (ValueError, TypeError):
-                            _LOGGER.warning(
-                                "Aggregator: Could not parse datetime '%s' for comparison (attribute '%s', device %s). Using raw string if latest.",
-                                value_str, attribute, device_alias
-                            )
-                            # Fallback: use the first non-empty raw string encountered
-                            if attribute == "Update_time" and latest_update_time_str is None: latest_update_time_str = value_str
+            # Find the latest timestamp across all devices
+            update_time_str = latest_row_data.get("Update_time")
+            if update_time_str:
+                try:
+                    current_time_obj = _parse_utc_timestamp(update_time_str)
+                    if compare_update_time_obj is None or current_time_obj > compare_update_time_obj:
+                        compare_update_time_obj = current_time_obj
+                        latest_update_time_str = update_time_str
+                except (ValueError, TypeError):
+                    _LOGGER.warning(
+                        "Aggregator: Could not parse datetime '%s' for comparison (attribute 'Update_time', device %s). Using raw string if latest.",
+                        update_time_str, device_alias
+                    )
+                    # Fallback: use the first non-empty raw string encountered
+                    if latest_update_time_str is None: latest_update_time_str = update_time_str
 
         except Exception as e:
             _LOGGER.error("Aggregator: Error processing data for device %s: %s", device_alias, e, exc_info=True)
             continue
 
     aggregated_data = {
-        "Power": round(plant_sum_power, 2),
-        "Energy_Today": round(plant_sum_energy_today, 2),
-        "Energy_This_Month": round(plant_sum_energy_month, 2),
-        "Energy_This_Year": round(plant_sum_energy_year, 2),
-        "Energy_Total": round(plant_sum_energy_total, 2),
-        "Panel_Power": round(plant_sum_panel_power, 2), # Total power from all panels
+        **{attribute: round(sums[slot], 2) for attribute, slot in _SUM_SLOTS.items()},
+        "Panel_Power": round(sums[_PANEL_POWER_SLOT], 2), # Total power from all panels
         "Update_time": latest_update_time_str,
     }
     _LOGGER.debug("Aggregator: Aggregated plant data: %s", aggregated_data)
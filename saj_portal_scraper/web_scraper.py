@@ -1,7 +1,12 @@
 # /workspaces/addons/saj_portal_scraper/web_scraper.py
+import gzip
 import logging
+import subprocess
+import threading
 import time
-from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone, timedelta
+from functools import lru_cache
 import os
 
 _LOGGER = logging.getLogger(__name__)
@@ -35,50 +40,169 @@ except ImportError:
 from const import (
     GECKODRIVER_PATH,
     FIREFOX_BINARY_PATH,
-    COLUMN_MAPPING,
+    COLUMN_NAMES,
+    COLUMN_INDICES,
     build_saj_urls,
     USERNAME_SELECTOR,
     PASSWORD_SELECTOR,
     DEFAULT_USERNAME,
     DEFAULT_PASSWORD,
     DEFAULT_MICROINVERTERS,
-    FIREFOX_PROFILE_PATH
+    FIREFOX_PROFILE_PATH,
+    DEBUG_DUMP_DIR,
+    DEBUG_DUMP_PREFIX,
+    DEBUG_DUMP_INTERVAL,
+    DEBUG_DUMP_MAX_PER_DAY,
+    DEBUG_DUMP_MAX_AGE_DAYS,
+    DEBUG_DUMP_MAX_CHARS,
+    LOGIN_FAILURE_COOLDOWN,
 )
-
-def is_session_expired(driver, config):
-    """Detects if the session has expired by checking if it is on the login screen."""
-    saj_urls = build_saj_urls(config)
-    login_url = saj_urls["LOGIN_URL"]
-    _LOGGER.debug(f"Checking expired session...")
+import persistence
+import utils
+
+_PANEL_COLUMNS = frozenset(("Panel_Voltage", "Panel_Current", "Panel_Power")) # Split per channel
+_NON_VALUE_COLUMNS = frozenset(("Update_time", "Panel_Channel")) # Handled separately / only used to name channels
+
+# Poll interval of the explicit waits; the table and login form usually appear well within Selenium's default 0.5 s
+_WAIT_POLL_FREQUENCY = 0.1
+
+# --- Locators ---
+# Built once and shared by the waits and lookups below
+_TABLE_ROW_SELECTOR = ".el-table__body-wrapper tbody tr"
+_TABLE_ROW_LOCATOR = (By.CSS_SELECTOR, _TABLE_ROW_SELECTOR)
+_USERNAME_LOCATOR = (By.CSS_SELECTOR, USERNAME_SELECTOR)
+_PASSWORD_LOCATOR = (By.CSS_SELECTOR, PASSWORD_SELECTOR)
+
+# Current URL and whether the login form's username field is on the page
+_SESSION_STATE_SCRIPT = "return [location.href, document.querySelector(arguments[0]) !== null];"
+
+# Text of every cell of the first data row, read in the browser in a single WebDriver round-trip
+_FIRST_ROW_CELLS_SCRIPT = f"""
+const row = document.querySelector('{_TABLE_ROW_SELECTOR}');
+return row ? Array.from(row.querySelectorAll('td'), td => td.innerText.trim()) : null;
+"""
+
+@lru_cache(maxsize=4)
+def _parse_microinverters(microinverters_str: str) -> tuple[tuple[str, str], ...]:
+    """Parses the "SN1:Alias1,SN2:Alias2" option into (sn, alias) pairs. Cached per option value."""
+    microinverter_map = {}
+    for pair in microinverters_str.split(","):
+        sn, sep, alias = pair.partition(":")
+        if sep and ":" not in alias: # Exactly one "SN:Alias" separator
+            microinverter_map[sn.strip()] = alias.strip()
+    # Logged once per configuration, not on every fetch
+    _LOGGER.debug("Configured microinverters: %s", microinverter_map)
+    return tuple(microinverter_map.items())
+
+@lru_cache(maxsize=8)
+def _get_local_tz(local_tz_str: str):
+    """Resolves the timezone named by the TZ environment variable, falling back to UTC. Cached per name."""
     try:
-        # Check if on the login URL
-        if login_url in driver.current_url:
-            return True
-        # Check if the username field is present
-        login_fields = driver.find_elements(By.CSS_SELECTOR, USERNAME_SELECTOR)
-        if login_fields:
-            return True
+        local_tz = ZoneInfo(local_tz_str)
+        _LOGGER.debug("Using local timezone: %s (%s)", local_tz_str, local_tz)
+        return local_tz
+    except ZoneInfoNotFoundError:
+        _LOGGER.warning(f"Timezone '{local_tz_str}' not found. Falling back to UTC.")
     except Exception as e:
-        _LOGGER.debug(f"Error while checking session expiration: {e}")
-    return False
+        _LOGGER.error(f"Error getting timezone '{local_tz_str}': {e}. Falling back to UTC.")
+    return ZoneInfo("UTC")
 
-def _is_data_url_in(driver, config):
-    """Check if the current page is a data url page (ignoring the variable part at the end)."""
-    saj_urls = build_saj_urls(config)
-    data_url_template = saj_urls["DATA_URL_TEMPLATE"]
-    _LOGGER.debug(f"Checking current URL...")
+_last_dump_at: float | None = None # Monotonic time of the last page source dump
+_dumps_today: tuple[date, int] = (date.min, 0) # (day, dumps saved that day)
+# Compresses and writes dumps off the fetch thread; created on first use
+_dump_executor: ThreadPoolExecutor | None = None
+
+def _write_dump(filename: str, current_url: str, page_html: str):
+    """Writes a gzipped page source dump. Runs on the dump executor."""
+    try:
+        with gzip.open(filename, "wt", encoding="utf-8") as f:
+            f.write(f"<!-- URL: {current_url} -->\n")
+            f.write(page_html)
+        _LOGGER.error(f"Page source saved to {filename} for debugging. URL: {current_url}")
+    except Exception as dump_err:
+        _LOGGER.error("Failed to save page source to %s: %s", filename, dump_err)
+
+def _dump_page_source(driver, reason: str, driver_alive: bool | None = None):
+    """Saves the current page (gzipped) to DEBUG_DUMP_DIR for troubleshooting, at most once per DEBUG_DUMP_INTERVAL.
+    driver_alive skips the liveness probe when the caller already knows the answer."""
+    global _last_dump_at, _dump_executor, _dumps_today
+    now = time.monotonic()
+    if _last_dump_at is not None and now - _last_dump_at < DEBUG_DUMP_INTERVAL:
+        _LOGGER.debug("Not saving page source for %s: a dump was already saved in the last %d seconds.", reason, DEBUG_DUMP_INTERVAL)
+        return
+    today = date.today()
+    dump_count = _dumps_today[1] if _dumps_today[0] == today else 0
+    if dump_count >= DEBUG_DUMP_MAX_PER_DAY:
+        _LOGGER.debug("Not saving page source for %s: daily limit of %d dumps reached.", reason, DEBUG_DUMP_MAX_PER_DAY)
+        return
+    _dumps_today = (today, dump_count + 1)
+    _last_dump_at = now
+    try:
+        if driver_alive is None:
+            driver_alive = driver is not None and _is_driver_connected(driver)
+        if driver_alive:
+            try:
+                page_html = driver.page_source
+            except Exception as page_err:
+                page_html = f"<no page source available: {page_err}>"
+            try:
+                current_url = driver.current_url
+            except Exception as url_err:
+                current_url = f"<unavailable: {url_err}>"
+        else:
+            # Do NOT attempt to access any driver property if not connected
+            page_html = "<no driver or driver disconnected>"
+            current_url = "<no driver or driver disconnected>"
+        if len(page_html) > DEBUG_DUMP_MAX_CHARS:
+            page_html = page_html[:DEBUG_DUMP_MAX_CHARS] + "\n<!-- truncated -->"
+        filename = os.path.join(DEBUG_DUMP_DIR, f"{DEBUG_DUMP_PREFIX}{reason}_{int(time.time())}.html.gz")
+        # Reading the page needs the driver; compressing and writing it doesn't
+        if _dump_executor is None:
+            _dump_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="debug_dump", initializer=utils.block_shutdown_signals)
+        _dump_executor.submit(_write_dump, filename, current_url, page_html)
+    except Exception as dump_err:
+        _LOGGER.error("Failed to save page source for %s: %s", reason, dump_err)
+
+def cleanup_debug_dumps():
+    """Deletes page source dumps older than DEBUG_DUMP_MAX_AGE_DAYS."""
+    cutoff = time.time() - DEBUG_DUMP_MAX_AGE_DAYS * 86400
+    removed = 0
     try:
-        base_data_url = data_url_template.split("{")[0]
-        _LOGGER.debug(f"Current URL: {driver.current_url}")
-        if driver.current_url.startswith(base_data_url) and not is_session_expired(driver, config):
+        with os.scandir(DEBUG_DUMP_DIR) as entries:
+            for entry in entries:
+                if entry.name.startswith(DEBUG_DUMP_PREFIX) and entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+    except OSError as e:
+        _LOGGER.warning(f"Could not clean up old debug dumps in {DEBUG_DUMP_DIR}: {e}")
+    if removed:
+        _LOGGER.info(f"Deleted {removed} debug page dump(s) older than {DEBUG_DUMP_MAX_AGE_DAYS} days.")
+
+def is_session_expired(driver, saj_urls, current_url: str | None = None):
+    """Detects if the session has expired by checking if it is on the login screen.
+    saj_urls comes from build_saj_urls; pass current_url if the caller already read it from the driver."""
+    _LOGGER.debug("Checking expired session...")
+    try:
+        if current_url is not None and saj_urls["LOGIN_URL"] in current_url:
+            return True
+        # URL and login form presence in a single round-trip (no element references sent back)
+        page_url, has_login_form = driver.execute_script(_SESSION_STATE_SCRIPT, USERNAME_SELECTOR)
+        # Check if on the login URL, or if the username field is present
+        if saj_urls["LOGIN_URL"] in page_url or has_login_form:
             return True
-        _LOGGER.debug(f"Data URL Checked. URL: {driver.current_url}")
     except Exception as e:
-        _LOGGER.debug(f"Error checking Data URL: {e}")
+        _LOGGER.debug("Error while checking session expiration: %s", e)
     return False
 
+_last_login_failure: float | None = None # Monotonic time of the last failed login
+
 def _perform_login(driver, config):
-    """Performs login using the provided driver and config. Returns True if successful."""
+    """Performs login using the provided driver and config. Returns True if successful.
+    Within LOGIN_FAILURE_COOLDOWN of a failed login, fails right away without contacting the portal."""
+    global _last_login_failure
+    if _last_login_failure is not None and time.monotonic() - _last_login_failure < LOGIN_FAILURE_COOLDOWN:
+        _LOGGER.warning("Skipping login: the last attempt failed less than %d seconds ago.", LOGIN_FAILURE_COOLDOWN)
+        return False
     saj_urls = build_saj_urls(config)
     login_url = saj_urls["LOGIN_URL"]
     dashboard_url = saj_urls["DASHBOARD_URL"]
@@ -87,9 +211,9 @@ def _perform_login(driver, config):
         username = config.get("saj_username", DEFAULT_USERNAME)
         password = config.get("saj_password", DEFAULT_PASSWORD)
         driver.get(login_url)
-        wait = WebDriverWait(driver, 30)
-        username_field = wait.until(EC.visibility_of_element_located((By.CSS_SELECTOR, USERNAME_SELECTOR)))
-        password_field = driver.find_element(By.CSS_SELECTOR, PASSWORD_SELECTOR)
+        wait = WebDriverWait(driver, 30, poll_frequency=_WAIT_POLL_FREQUENCY)
+        username_field = wait.until(EC.visibility_of_element_located(_USERNAME_LOCATOR))
+        password_field = driver.find_element(*_PASSWORD_LOCATOR)
         username_field.clear()
         username_field.send_keys(username)
         password_field.clear()
@@ -97,41 +221,129 @@ def _perform_login(driver, config):
         password_field.send_keys(Keys.RETURN)
         wait.until(EC.url_to_be(dashboard_url))
         _LOGGER.info("Login successful.")
+        _last_login_failure = None
+        try:
+            persistence.save_session_cookies(driver.get_cookies())
+        except Exception as cookie_err:
+            _LOGGER.warning("Could not save session cookies: %s", cookie_err)
         return True
     except Exception as login_err:
         _LOGGER.error("Login failed: %s", login_err)
+        _last_login_failure = time.monotonic()
+        _dump_page_source(driver, "login_failed")
+        return False
+
+def _restore_session(driver, config) -> bool:
+    """Re-applies the cookies of the last login. Returns True if the portal accepts them (no login needed)."""
+    now = time.time()
+    cookies = [c for c in persistence.load_session_cookies() if not c.get("expiry") or c["expiry"] > now]
+    if not cookies:
+        return False
+    saj_urls = build_saj_urls(config)
+    try:
+        _LOGGER.debug("Restoring %d session cookie(s)...", len(cookies))
+        driver.get(saj_urls["LOGIN_URL"]) # Cookies can only be added for the domain currently loaded
+        for cookie in cookies:
+            try:
+                driver.add_cookie(cookie)
+            except WebDriverException as cookie_err:
+                _LOGGER.debug("Skipping cookie %s: %s", cookie.get("name"), cookie_err)
+        # Load the first device's data page when there is one: its table marks a valid session, so the wait
+        # below ends as soon as either outcome is visible (an expired session is sent to the login page)
+        microinverter_map = _parse_microinverters(config.get("microinverters", ""))
+        outcomes = [EC.url_contains(saj_urls["LOGIN_URL"]), EC.presence_of_element_located(_USERNAME_LOCATOR)]
+        if microinverter_map:
+            driver.get(saj_urls["DATA_URL_TEMPLATE"].format(device_sn=microinverter_map[0][0]))
+            outcomes.append(EC.presence_of_element_located(_TABLE_ROW_LOCATOR))
+        else:
+            driver.get(saj_urls["DASHBOARD_URL"])
         try:
-            page_html = driver.page_source
-            filename = f"/data/saj_debug_login_failed_{int(time.time())}.html"
-            with open(filename, "w", encoding="utf-8") as f:
-                f.write(f"<!-- URL: {driver.current_url} -->\n")
-                f.write(page_html)
-            _LOGGER.error(f"Page source saved to {filename} for debugging login failure. URL: {driver.current_url}")
-        except Exception as dump_err:
-            _LOGGER.error("Failed to save page source during login failure: %s", dump_err)
+            WebDriverWait(driver, 10, poll_frequency=_WAIT_POLL_FREQUENCY).until(EC.any_of(*outcomes))
+        except TimeoutException:
+            pass # Neither marker showed up; decided by the login page check below
+        if is_session_expired(driver, saj_urls):
+            _LOGGER.info("Saved session has expired. Logging in again.")
+            return False
+        _LOGGER.info("Restored the previous SAJ Portal session. Skipping login.")
+        return True
+    except Exception as restore_err:
+        _LOGGER.debug("Could not restore the previous session: %s", restore_err)
         return False
 
+def _remove_stale_profile_locks(profile_path: str) -> bool:
+    """Removes the locks a killed Firefox left in profile_path. Returns False (keeping them) if the
+    Firefox that holds the profile is still running, e.g. after a driver.quit() that failed."""
+    lock_file = os.path.join(profile_path, "lock")
+    try:
+        # Firefox's lock is a symlink to "<ip>:+<pid>"
+        pid = int(os.readlink(lock_file).rpartition("+")[2])
+        os.kill(pid, 0)
+        return False # Still alive
+    except (FileNotFoundError, ValueError, ProcessLookupError):
+        pass # No lock, unreadable lock or dead owner
+    except PermissionError:
+        return False # Alive, owned by another user
+    for lock_name in ("lock", ".parentlock", "parent.lock"):
+        try:
+            os.remove(os.path.join(profile_path, lock_name))
+        except FileNotFoundError:
+            pass
+    return True
+
 def validate_connection(config: dict) -> webdriver.Firefox:
     """Validate connection and return logged-in WebDriver instance."""
     _LOGGER.info("Validating connection...")
-    #os.makedirs(FIREFOX_PROFILE_PATH, exist_ok=True)
+    # Persistent profile, so the portal's scripts, styles and fonts stay in the HTTP cache across driver restarts
+    try:
+        os.makedirs(FIREFOX_PROFILE_PATH, exist_ok=True)
+        # Locks left behind by a killed instance would block the profile; a live owner must keep it
+        if _remove_stale_profile_locks(FIREFOX_PROFILE_PATH):
+            profile_path = FIREFOX_PROFILE_PATH
+        else:
+            _LOGGER.warning(f"Firefox profile {FIREFOX_PROFILE_PATH} is still in use by a running Firefox. Using a temporary one.")
+            profile_path = None
+    except OSError as profile_err:
+        _LOGGER.warning(f"Cannot use persistent Firefox profile {FIREFOX_PROFILE_PATH}: {profile_err}. Using a temporary one.")
+        profile_path = None
     options = Options()
+    # driver.get returns at DOMContentLoaded; every caller waits for the elements it needs explicitly
+    options.page_load_strategy = "eager"
     options.add_argument("--headless")
     options.add_argument("--disable-gpu")
     options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage")
     options.add_argument("--disable-extensions")
     options.add_argument("--disable-software-rasterizer")
-    #options.add_argument(f"--profile")
-    #options.add_argument(FIREFOX_PROFILE_PATH)
+    if profile_path:
+        options.add_argument("-profile")
+        options.add_argument(profile_path)
+        options.set_preference("browser.cache.disk.enable", True)
+        options.set_preference("browser.cache.disk.capacity", 256000) # KB
+        # A reused profile must not reopen the tabs of a previous (possibly killed) instance at startup
+        options.set_preference("browser.startup.page", 0)
+        options.set_preference("browser.sessionstore.resume_from_crash", False)
     options.set_preference("security.sandbox.content.level", 0)
+    # Background services a scraper has no use for
+    options.set_preference("toolkit.telemetry.enabled", False)
+    options.set_preference("datareporting.healthreport.uploadEnabled", False)
+    options.set_preference("datareporting.policy.dataSubmissionEnabled", False)
+    options.set_preference("app.update.enabled", False)
+    options.set_preference("browser.safebrowsing.malware.enabled", False)
+    options.set_preference("browser.safebrowsing.phishing.enabled", False)
+    options.set_preference("network.prefetch-next", False)
+    # Only the table text is read: skip images and web fonts. Stylesheets stay, innerText depends on layout
+    options.set_preference("permissions.default.image", 2)
+    options.set_preference("gfx.downloadable_fonts.enabled", False)
 
     options.binary_location = FIREFOX_BINARY_PATH
-    service = Service(GECKODRIVER_PATH)
+    # geckodriver otherwise appends INFO logs for every command to ./geckodriver.log
+    service = Service(GECKODRIVER_PATH, service_args=["--log", "fatal"], log_output=subprocess.DEVNULL)
 
     try:
         _LOGGER.debug("Initializing Firefox WebDriver...")
-        driver = webdriver.Firefox(service=service, options=options)
+        # Called from the (signal-blocking) cycle worker: geckodriver must not inherit the blocked mask
+        with utils.shutdown_signals_unblocked():
+            driver = webdriver.Firefox(service=service, options=options)
         driver.set_page_load_timeout(60)
         driver.set_script_timeout(30)
         _LOGGER.debug("WebDriver initialized successfully.")
@@ -139,7 +351,7 @@ def validate_connection(config: dict) -> webdriver.Firefox:
         _LOGGER.exception("Failed to initialize Firefox WebDriver. Check paths and permissions. Error: %s", init_err)
         raise RuntimeError(f"WebDriver Initialization Failed: {init_err}") from init_err
     try:
-        if not _perform_login(driver, config):
+        if not _restore_session(driver, config) and not _perform_login(driver, config):
             raise ValueError("Login failed: Unable to complete login with provided credentials.")
         return driver
     except Exception as login_err:
@@ -148,8 +360,11 @@ def validate_connection(config: dict) -> webdriver.Firefox:
         raise ValueError(f"Login failed: {login_err}") from login_err
 
 
-def _fetch_data_sync(config: dict, driver: webdriver.Firefox, force_relogin: bool = False) -> dict:
-    """Synchronous function to fetch data using Selenium."""
+def _fetch_data_sync(config: dict, driver: webdriver.Firefox, force_relogin: bool = False,
+                     stop_event: threading.Event | None = None) -> tuple[dict, webdriver.Firefox | None]:
+    """Synchronous function to fetch data using Selenium.
+    Returns the data per device and the driver to keep using, which is a new one if the session had to be recreated.
+    Once stop_event is set, no further device is read and no recovery (re-login, new driver) is attempted."""
 
     _LOGGER.info("Starting data collection...")
 
@@ -160,43 +375,31 @@ def _fetch_data_sync(config: dict, driver: webdriver.Firefox, force_relogin: boo
     microinverters_str = config.get("microinverters", "")
     if not microinverters_str:
         _LOGGER.warning("No microinverters configured. Returning empty data.")
-        return {}
+        return {}, driver
     try:
-        microinverter_map = {
-            pair.split(":")[0].strip(): pair.split(":")[1].strip()
-            for pair in microinverters_str.split(",")
-            if ":" in pair and len(pair.split(":")) == 2
-        }
+        microinverter_map = _parse_microinverters(microinverters_str)
         if not microinverter_map:
             _LOGGER.error("Microinverters string '%s' is invalid or empty after parsing.", microinverters_str)
-            return {}
+            return {}, driver
     except Exception as parse_err:
         _LOGGER.error("Invalid microinverters format in config: '%s'. Error: %s", microinverters_str, parse_err)
-        return {}
+        return {}, driver
 
     all_device_data = {}
     wait_timeout = 60
+    saj_urls = build_saj_urls(config)
+    data_url_template = saj_urls["DATA_URL_TEMPLATE"]
 
-    # Determine the local timezone ONCE using the TZ environment variable
-    try:
-        local_tz_str = os.environ.get("TZ", "UTC")
-        local_tz = ZoneInfo(local_tz_str)
-        _LOGGER.debug(f"Using local timezone: {local_tz_str} ({local_tz})")
-    except ZoneInfoNotFoundError:
-        _LOGGER.warning(f"Timezone '{local_tz_str}' not found. Falling back to UTC.")
-        local_tz = ZoneInfo("UTC")
-    except Exception as e:
-        _LOGGER.error(f"Error getting timezone '{local_tz_str}': {e}. Falling back to UTC.")
-        local_tz = ZoneInfo("UTC")
+    # Local timezone from the TZ environment variable (resolved once per value)
+    local_tz = _get_local_tz(os.environ.get("TZ", "UTC"))
     utc_tz = timezone.utc
+    local_tz_is_utc = getattr(local_tz, "key", None) in ("UTC", "Etc/UTC") # Portal times are then already UTC
 
-    # Log all microinverter aliases and serials at debug level
-    for sn, alias in microinverter_map.items():
-        _LOGGER.debug(f"Configured microinverter: SN={sn}, Alias={alias}")
-
-    for device_sn, device_alias in microinverter_map.items():
-        saj_urls = build_saj_urls(config)
-        data_url = saj_urls["DATA_URL_TEMPLATE"].format(device_sn=device_sn)
+    for device_sn, device_alias in microinverter_map:
+        if stop_event is not None and stop_event.is_set():
+            _LOGGER.info("Shutdown requested. Stopping data collection.")
+            break
+        data_url = data_url_template.format(device_sn=device_sn)
         _LOGGER.info("Fetching data for device %s (%s)...", device_alias, device_sn)
 
         max_attempts = 2  # Try each microinverter up to 2 times on connection errors
@@ -204,43 +407,36 @@ def _fetch_data_sync(config: dict, driver: webdriver.Firefox, force_relogin: boo
         while attempt < max_attempts:
             try:
                 attempt += 1
-                _LOGGER.debug(f"Calling driver.GET: {data_url} (microinverter attempt {attempt}/{max_attempts})")
+                _LOGGER.debug("Calling driver.GET: %s (microinverter attempt %d/%d)", data_url, attempt, max_attempts)
                 if not driver_get_with_retry(driver, data_url):
                     raise WebDriverException(f"Failed to load URL {data_url} after retries.")
-                time.sleep(4)
+                # Poll for the rendered table instead of sleeping a fixed time.
+                # The URL condition is part of the same wait: a table on any other page (or the
+                # login page after an expired session) never satisfies it and ends in a timeout
                 _LOGGER.debug("Calling WebDriverWait...")
-                WebDriverWait(driver, wait_timeout,poll_frequency=2).until(
-                    EC.presence_of_element_located((By.CSS_SELECTOR, ".el-table__body-wrapper tbody tr"))
-                )
+                WebDriverWait(driver, wait_timeout, poll_frequency=_WAIT_POLL_FREQUENCY).until(EC.all_of(
+                    EC.url_contains(saj_urls["DATA_URL_PREFIX"]),
+                    EC.presence_of_element_located(_TABLE_ROW_LOCATOR),
+                ))
                 _LOGGER.debug("WebDriverWait called successfully.")
 
-                if not _is_data_url_in(driver, config):
-                    raise WebDriverException("Failed to establish a new connection: Failed to navigate to data URL.")
-
                 _LOGGER.debug("Data table founded for device %s.", device_alias)
-                device_data_rows = {}
-                rows = driver.find_elements(By.CSS_SELECTOR, ".el-table__body-wrapper tbody tr")
-                _LOGGER.debug("Found %d rows in the table for device %s.", len(rows), device_alias)
+                cols = driver.execute_script(_FIRST_ROW_CELLS_SCRIPT)
 
-                if not rows:
+                if not cols:
                     _LOGGER.warning("No rows found in table for device %s after waiting.", device_alias)
                     break
 
-                row = rows[0]
-                cols = row.find_elements(By.TAG_NAME, "td")
                 col_count = len(cols)
+                _LOGGER.debug("Read %d cells from the first table row for device %s.", col_count, device_alias)
 
                 raw_row_data = {}
-                for column_name, column_index in COLUMN_MAPPING.items():
+                for column_name, column_index in zip(COLUMN_NAMES, COLUMN_INDICES):
                     if column_index >= col_count:
                         _LOGGER.warning("Column index %d for '%s' out of range (max %d) for device %s.",
                                         column_index, column_name, col_count -1, device_alias)
                         continue
-                    try:
-                        raw_row_data[column_name] = cols[column_index].text.strip()
-                    except Exception as col_err:
-                        _LOGGER.error("Error extracting raw column '%s' for device %s: %s", column_name, device_alias, col_err)
-                        raw_row_data[column_name] = None
+                    raw_row_data[column_name] = cols[column_index]
 
                 row_data = {}
                 raw_update_time = raw_row_data.get("Update_time")
@@ -248,11 +444,12 @@ def _fetch_data_sync(config: dict, driver: webdriver.Firefox, force_relogin: boo
 
                 if raw_update_time:
                     try:
-                        naive_update_dt = datetime.strptime(raw_update_time, "%Y-%m-%d %H:%M:%S")
-                        local_update_dt = naive_update_dt.replace(tzinfo=local_tz)
-                        utc_update_dt = local_update_dt.astimezone(utc_tz)
-                        processed_update_time = utc_update_dt.strftime("%Y-%m-%dT%H:%M:%SZ")
-                        _LOGGER.debug(f"Processed Update_time for {device_alias}: Raw='{raw_update_time}' (Local TZ={local_tz}) -> UTC='{processed_update_time}'")
+                        # Portal format is "YYYY-MM-DD HH:MM:SS"; fromisoformat parses it in C, unlike strptime
+                        naive_update_dt = datetime.fromisoformat(raw_update_time)
+                        if not local_tz_is_utc:
+                            naive_update_dt = naive_update_dt.replace(tzinfo=local_tz).astimezone(utc_tz).replace(tzinfo=None)
+                        processed_update_time = naive_update_dt.isoformat(timespec="seconds") + "Z"
+                        _LOGGER.debug("Processed Update_time for %s: Raw='%s' (Local TZ=%s) -> UTC='%s'", device_alias, raw_update_time, local_tz, processed_update_time)
                     except ValueError as parse_err:
                         _LOGGER.warning(f"Could not parse Update_time string for {device_alias}: '{raw_update_time}'. Error: {parse_err}. Using raw value.")
                     except Exception as tz_err:
@@ -260,27 +457,26 @@ def _fetch_data_sync(config: dict, driver: webdriver.Firefox, force_relogin: boo
 
                 row_data["Update_time"] = processed_update_time
 
+                # Panel cells hold one line per channel (e.g. "PV1\nPV2"); the channel names are split once per row
+                raw_channel_value = raw_row_data.get("Panel_Channel")
+                channel_keys = [c.strip().upper() for c in raw_channel_value.split("\n")] if raw_channel_value is not None else None
+
                 for column_name, raw_value in raw_row_data.items():
-                    if column_name not in ["Update_time"]:
-                        if column_name in ["Panel_Voltage", "Panel_Current", "Panel_Power"]:
-                            channel_col_index = COLUMN_MAPPING.get("Panel_Channel")
-                            raw_channel_value = raw_row_data.get("Panel_Channel")
-                            if channel_col_index is not None and raw_channel_value is not None and raw_value is not None:
-                                channel_values = raw_channel_value.split("\n")
-                                values = raw_value.split("\n")
-                                num_channels = len(channel_values)
-                                num_values = len(values)
-                                if num_channels == num_values:
-                                    for i in range(num_channels):
-                                        channel_key = channel_values[i].strip().upper()
-                                        if channel_key:
-                                            row_data[f"{channel_key}_{column_name}"] = values[i].strip()
-                                else:
-                                    row_data[column_name] = raw_value
-                            elif raw_value is not None:
+                    if column_name in _PANEL_COLUMNS:
+                        if channel_keys is not None and raw_value is not None:
+                            values = raw_value.split("\n")
+                            if len(values) == len(channel_keys):
+                                row_data.update({
+                                    f"{channel_key}_{column_name}": value.strip()
+                                    for channel_key, value in zip(channel_keys, values)
+                                    if channel_key
+                                })
+                            else:
                                 row_data[column_name] = raw_value
-                        elif column_name != "Panel_Channel":
+                        elif raw_value is not None:
                             row_data[column_name] = raw_value
+                    elif column_name not in _NON_VALUE_COLUMNS:
+                        row_data[column_name] = raw_value
 
                 row_data["Alias"] = device_alias
                 update_time_key = row_data.get("Update_time")
@@ -288,15 +484,9 @@ def _fetch_data_sync(config: dict, driver: webdriver.Firefox, force_relogin: boo
                 if not update_time_key or not isinstance(update_time_key, str) or 'Z' not in update_time_key:
                     _LOGGER.warning("Skipping row for device %s because processed 'Update_time' ('%s') is invalid.", device_alias, update_time_key)
                 else:
-                    device_data_rows[update_time_key] = row_data
-                    _LOGGER.debug("Processed row with UTC update time %s for device %s.", update_time_key, device_alias)
-
-                if device_data_rows:
-                    latest_time = max(device_data_rows.keys())
-                    all_device_data[device_sn] = device_data_rows[latest_time]
-                    _LOGGER.debug("Stored latest data for %s (UTC update time: %s)", device_alias, latest_time)
-                else:
-                    _LOGGER.warning("No valid rows with converted update_time processed for device %s.", device_alias)
+                    # The first row is the latest reading
+                    all_device_data[device_sn] = row_data
+                    _LOGGER.debug("Stored latest data for %s (UTC update time: %s)", device_alias, update_time_key)
                 break  # Success, exit retry loop
 
             except (TimeoutException, NoSuchElementException, WebDriverException, MaxRetryError, NewConnectionError) as fetch_err:
@@ -311,39 +501,29 @@ def _fetch_data_sync(config: dict, driver: webdriver.Firefox, force_relogin: boo
                 if is_timeout or is_conn_refused:
                     err_type = "Timeout" if is_timeout else "WebDriver connection refused"
                     _LOGGER.error(f"{err_type} while fetching data for device %s (%s). URL: %s", device_alias, device_sn, data_url, exc_info=fetch_err)
-                    try:
-                        if driver and _is_driver_connected(driver):
-                            try:
-                                page_html = driver.page_source
-                            except Exception as page_err:
-                                page_html = f"<no page source available: {page_err}>"
-                            try:
-                                current_url = driver.current_url
-                            except Exception as url_err:
-                                current_url = f"<unavailable: {url_err}>"
+                    # A refused connection means the WebDriver is gone; only a timeout needs the probe (once)
+                    driver_alive = is_timeout and driver is not None and _is_driver_connected(driver)
+                    # Transient errors are retried; the page is only kept once the recovery failed too (or when debugging)
+                    if attempt == max_attempts or _LOGGER.isEnabledFor(logging.DEBUG):
+                        _dump_page_source(driver, f"data_{'timeout' if is_timeout else 'connrefused'}_{device_alias}", driver_alive)
+                    if stop_event is not None and stop_event.is_set():
+                        # The WebDriver may have been quit by the shutdown itself; don't start a new one
+                        _LOGGER.info("Shutdown requested. Skipping recovery for device %s.", device_alias)
+                        break
+                    if attempt < max_attempts and driver_alive:
+                        # The browser is fine, only the page was slow or the session expired: keep the process
+                        if is_session_expired(driver, saj_urls):
+                            _LOGGER.info("Session expired. Logging in again with the current WebDriver...")
+                            _perform_login(driver, config)
                         else:
-                            # Do NOT attempt to access any driver property if not connected
-                            page_html = "<no driver or driver disconnected>"
-                            current_url = "<no driver or driver disconnected>"
-                        filename = f"/data/saj_debug_data_{'timeout' if is_timeout else 'connrefused'}_{device_alias}_{int(time.time())}.html"
-                        with open(filename, "w", encoding="utf-8") as f:
-                            f.write(f"<!-- URL: {current_url} -->\n")
-                            f.write(page_html)
-                        _LOGGER.error(f"Page source saved to {filename} for debugging {err_type.lower()}. URL: {current_url}")
-                    except Exception as dump_err:
-                        _LOGGER.error("Failed to save page source during %s: %s", err_type.lower(), dump_err)
+                            _LOGGER.info("WebDriver still responsive. Retrying device %s with the current session...", device_alias)
+                        continue
                     if attempt < max_attempts:
                         _LOGGER.info("Quitting driver, waiting 5 seconds, and attempting to re-login due to %s...", err_type.lower())
-                        try:
-                            _LOGGER.debug("Verifying Webdriver...")
-                            if driver:
-                                driver.quit()
-                                driver = None
-                                _LOGGER.debug("Webdriver quit successfully.")
-                        except Exception as e:
-                            _LOGGER.warning(f"Exception on driver.quit(): {e}")
-                        time.sleep(5)
-                        driver = validate_connection(config)
+                        driver = _recreate_driver(driver, config, stop_event=stop_event)
+                        if driver is None:
+                            _LOGGER.info("Shutdown requested. Not starting a new WebDriver.")
+                            break
                         continue
                     else:
                         _LOGGER.error("Error after recovery attempt.")
@@ -359,7 +539,7 @@ def _fetch_data_sync(config: dict, driver: webdriver.Firefox, force_relogin: boo
 
 
     _LOGGER.info("Finished fetching data for all configured devices.")
-    return all_device_data
+    return all_device_data, driver
 
 def _is_driver_connected(driver):
     """Check if the Selenium WebDriver is still connected and responsive."""
@@ -370,32 +550,52 @@ def _is_driver_connected(driver):
     except Exception:
         return False
 
+def try_refresh_driver(driver) -> bool:
+    """Tries to recover a misbehaving WebDriver with a page refresh. Returns True if it is responsive afterwards."""
+    try:
+        _LOGGER.debug("Refreshing page to recover WebDriver...")
+        driver.refresh()
+        return _is_driver_connected(driver)
+    except Exception as e:
+        _LOGGER.debug("WebDriver refresh failed: %s", e)
+        return False
+
+def _recreate_driver(driver, config: dict, delay_seconds: float = 5,
+                     stop_event: threading.Event | None = None) -> webdriver.Firefox | None:
+    """Quits a broken WebDriver (ignoring errors), waits delay_seconds and returns a new, logged-in one.
+    Returns None instead if stop_event is set before the new one would be started."""
+    if driver:
+        try:
+            driver.quit()
+            _LOGGER.debug("Webdriver quit successfully.")
+        except Exception as e:
+            _LOGGER.warning(f"Exception on driver.quit(): {e}")
+    if stop_event is None:
+        time.sleep(delay_seconds)
+    elif stop_event.wait(delay_seconds):
+        return None
+    return validate_connection(config)
+
 def driver_get_with_retry(driver, url):
     """
     Try to open the given URL with the driver, retrying up to max_attempts times if connection errors occur.
-    Adds a delay (sleep) before each attempt.
+    Waits delay_seconds between attempts.
     Returns True if successful, False otherwise.
     """
     max_attempts=3
     delay_seconds=5
     for attempt in range(1, max_attempts + 1):
         try:
-            time.sleep(2)
-            _LOGGER.debug(f"Driver.get attempt {attempt}/{max_attempts} - driver.get({url})")
+            _LOGGER.debug("Driver.get attempt %d/%d - driver.get(%s)", attempt, max_attempts, url)
             driver.get(url)
             return True
-        except (WebDriverException, MaxRetryError, NewConnectionError) as e:
-            _LOGGER.warning(f"Attempt {attempt} failed to load URL {url}: {e}")
-            if attempt == max_attempts:
-                _LOGGER.error(f"All {max_attempts} attempts to load URL {url} failed.")
-                return False
-            else:
-                _LOGGER.info(f"Retrying in {delay_seconds} seconds...")
         except Exception as e:
-            _LOGGER.error(f"Unexpected error on attempt {attempt} to load URL {url}: {e}")
-            if attempt == max_attempts:
-                _LOGGER.error(f"All {max_attempts} attempts to load URL {url} failed.")
-                return False
+            if isinstance(e, (WebDriverException, MaxRetryError, NewConnectionError)):
+                _LOGGER.warning(f"Attempt {attempt} failed to load URL {url}: {e}")
             else:
-                _LOGGER.info(f"Retrying in {delay_seconds} seconds...")
+                _LOGGER.error(f"Unexpected error on attempt {attempt} to load URL {url}: {e}")
+        if attempt == max_attempts:
+            _LOGGER.error(f"All {max_attempts} attempts to load URL {url} failed.")
+            return False
+        _LOGGER.info(f"Retrying in {delay_seconds} seconds...")
         time.sleep(delay_seconds)
\ No newline at end of file